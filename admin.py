@@ -1,24 +1,28 @@
-import asyncio
+from dataclasses import replace
 from pathlib import Path
 from html import escape as h
+from typing import List
 
 from aiogram import Router, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 
-from sqlalchemy import select, func
+from sqlalchemy import select
 
-from texts import t
+from texts import t, SCREEN_MAP
 from config_service import btn_text_cached, set_btn_text, del_btn_text, load_button_overrides
 
 from settings import settings
-from db import get_session, User, ContentOverride
+from media_cache import forget_photo
+from broadcast import launch_broadcast, stop_broadcast
+from stats import funnel_report, rebuild_stats, total_users
+from db import get_session, User
 from admin_keyboards import (
     kb_admin_menu, kb_users_list, kb_user_card, kb_links_menu,
     kb_content_lang, kb_content_screens, kb_content_editor,
-    kb_params, kb_broadcast, kb_number_back
+    kb_params, kb_broadcast, kb_number_back, kb_stats, kb_back_menu
 )
 from config_service import (
     set_value, get_value, set_bool,
@@ -26,6 +30,7 @@ from config_service import (
     platinum_threshold, first_deposit_min,
     bcast_text, bcast_photo, set_bcast_text, set_bcast_photo,
     check_subscription_enabled, check_registration_enabled, check_deposit_enabled,
+    content_override, set_content_text, reset_content, ensure_config_fresh,
 )
 
 router = Router(name="admin")
@@ -35,13 +40,10 @@ router = Router(name="admin")
 
 async def _render_content_screen(c: CallbackQuery, lang: str, screen: str):
     title_key, text_key = SCREEN_MAP.get(screen, ('main_title', 'main_desc'))
-    async with get_session() as session:
-        res = await session.execute(select(ContentOverride).where(
-            ContentOverride.lang == lang, ContentOverride.screen == screen
-        ))
-        ov = res.scalar_one_or_none()
-    title = ov.title if ov and ov.title else title_key
-    text = ov.text if ov and ov.text else text_key
+    await ensure_config_fresh()
+    ov = content_override(lang, screen)
+    title = ov[0] if ov and ov[0] else title_key
+    text = ov[1] if ov and ov[1] else text_key
     msg = (f"🧩 Контент — <b>{screen}</b> [{lang.upper()}]\n\n"
            f"<b>Заголовок:</b> <code>{h(title)}</code>\n<b>Текст:</b>\n<code>{h(text)[:900]}</code>")
     await c.message.edit_text(msg, reply_markup=kb_content_editor(lang, screen), parse_mode='HTML')
@@ -88,17 +90,34 @@ PER_PAGE = 20
 
 @router.callback_query(F.data.startswith("adm:users:"))
 async def cb_users(c: CallbackQuery):
+    """
+    Keyset-пагинация по users.id (новые сверху), курсор — в callback_data:
+    adm:users:1 — первая страница, adm:users:a:<id> — старше id, adm:users:b:<id> — новее id.
+    """
     if not is_admin(c.from_user.id):
         return
-    page = max(1, int(c.data.split(":")[2]))
-    offset = (page - 1) * PER_PAGE
+    parts = c.data.split(":")
+    mode, cursor = (parts[2], int(parts[3])) if len(parts) > 3 else ("first", 0)
+
+    q = select(User).where(User.group_ab == 'A')
+    if mode == "b":
+        q = q.where(User.id > cursor).order_by(User.id.asc())
+    else:
+        if mode == "a":
+            q = q.where(User.id < cursor)
+        q = q.order_by(User.id.desc())
 
     async with get_session() as session:
-        total = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A'))
-        result = await session.execute(
-            select(User).where(User.group_ab == 'A').order_by(User.id.desc()).offset(offset).limit(PER_PAGE)
-        )
-        rows = result.scalars().all()
+        rows = (await session.execute(q.limit(PER_PAGE + 1))).scalars().all()
+    total = await total_users("A")
+
+    more = len(rows) > PER_PAGE
+    rows = rows[:PER_PAGE]
+    if mode == "b":
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = mode == "a", more
 
     items = []
     for u in rows:
@@ -107,12 +126,12 @@ async def cb_users(c: CallbackQuery):
         p = '💎' if u.is_platinum else ''
         items.append((u.telegram_id, f"{u.telegram_id}  R:{r}  D:{d}  {p}"))
 
-    has_prev = page > 1
-    has_next = total > offset + len(rows)
+    prev_cursor = rows[0].id if rows and has_prev else None
+    next_cursor = rows[-1].id if rows and has_next else None
 
     await c.message.edit_text(
         f"👤 Пользователи ({total})\nВыберите пользователя:",
-        reply_markup=kb_users_list(items, page, has_prev, has_next),
+        reply_markup=kb_users_list(items, prev_cursor, next_cursor),
         parse_mode='HTML'
     )
     await c.answer()
@@ -165,6 +184,12 @@ async def cb_user_card(c: CallbackQuery):
         await c.answer("Пользователь не найден", show_alert=True)
         return
 
+    text, markup = _user_card(u)
+    await c.message.edit_text(text, reply_markup=markup, parse_mode='HTML')
+    await c.answer()
+
+
+def _user_card(u: User):
     text = (
         f"🪪 <b>Карточка пользователя</b>\n\n"
         f"TG ID: <code>{u.telegram_id}</code>\n"
@@ -177,15 +202,93 @@ async def cb_user_card(c: CallbackQuery):
         f"Platinum: {'💎' if u.is_platinum else '•'}\n"
         f"Создан: {u.created_at:%Y-%m-%d %H:%M}"
     )
+    return text, kb_user_card(u.telegram_id, u.is_registered, u.has_deposit, u.is_platinum)
+
+
+# --- search (telegram_id / click_id / trader_id, only group A)
+SEARCH_LIMIT = 10
+SEARCH_MIN_PREFIX = 3
+
+
+class SearchState(StatesGroup):
+    waiting_query = State()
+
+
+def _prefix_range(col, prefix: str):
+    """col LIKE 'prefix%' как диапазон — работает по обычному B-tree индексу в SQLite и Postgres."""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (col >= prefix) & (col < upper)
 
+
+async def _find_users(query: str) -> List[User]:
+    """Точное совпадение по индексам, иначе — поиск по префиксу click_id / trader_id."""
+    q = query.strip()
+    if not q:
+        return []
+    base = select(User).where(User.group_ab == 'A')
+    async with get_session() as session:
+        exact = [User.click_id == q, User.trader_id == q]
+        if q.isdigit():
+            exact.insert(0, User.telegram_id == int(q))
+        for cond in exact:
+            rows = (await session.execute(base.where(cond).limit(SEARCH_LIMIT))).scalars().all()
+            if rows:
+                return list(rows)
+
+        if len(q) < SEARCH_MIN_PREFIX:
+            return []
+        found: List[User] = []
+        for col in (User.click_id, User.trader_id):
+            rows = (await session.execute(
+                base.where(_prefix_range(col, q)).order_by(col).limit(SEARCH_LIMIT)
+            )).scalars().all()
+            found.extend(u for u in rows if u not in found)
+        return found[:SEARCH_LIMIT]
+
+
+async def _answer_search(m: Message, query: str) -> None:
+    users = await _find_users(query)
+    if not users:
+        await m.answer("Ничего не найдено.", reply_markup=kb_back_menu())
+        return
+    if len(users) == 1:
+        text, markup = _user_card(users[0])
+        await m.answer(text, reply_markup=markup, parse_mode='HTML')
+        return
+    items = [(u.telegram_id, f"{u.telegram_id}  {u.trader_id or u.click_id or ''}") for u in users]
+    await m.answer(f"🔎 Найдено: {len(users)}", reply_markup=kb_users_list(items, None, None))
+
+
+@router.callback_query(F.data == "adm:search")
+async def cb_search(c: CallbackQuery, state: FSMContext):
+    if not is_admin(c.from_user.id):
+        return
     await c.message.edit_text(
-        text,
-        reply_markup=kb_user_card(u.telegram_id, u.is_registered, u.has_deposit, u.is_platinum),
-        parse_mode='HTML'
+        "🔎 Пришлите TG ID, click_id или trader_id (можно начало, от 3 символов):",
+        reply_markup=kb_number_back("adm:menu")
     )
+    await state.set_state(SearchState.waiting_query)
     await c.answer()
 
 
+@router.message(SearchState.waiting_query)
+async def on_search_query(m: Message, state: FSMContext):
+    if not is_admin(m.from_user.id):
+        return
+    await state.clear()
+    await _answer_search(m, m.text or "")
+
+
+@router.message(Command("find"))
+async def cmd_find(m: Message, command: CommandObject):
+    if not is_admin(m.from_user.id):
+        return
+    if not command.args:
+        await m.answer("Использование: /find <tg_id | click_id | trader_id>")
+        return
+    await _answer_search(m, command.args)
+
+
 # --- postbacks (helper text with code blocks)
 @router.callback_query(F.data == "adm:postbacks")
 async def cb_postbacks(c: CallbackQuery):
@@ -307,18 +410,6 @@ async def cb_content_lang(c: CallbackQuery):
     await c.message.edit_text(f"Язык: {lang.upper()}\nВыберите экран:", reply_markup=kb_content_screens(lang))
     await c.answer()
 
-SCREEN_MAP = {
-    'main': ('main_title', 'main_desc'),
-    'instruction': ('instruction_title', 'instruction_text'),
-    'subscribe': ('subscribe_title', 'subscribe_text'),
-    'register': ('register_title', 'register_text'),
-    'deposit': ('deposit_title', 'deposit_text'),
-    'access': ('access_title', 'access_text'),
-    'platinum': ('platinum_title', 'platinum_text'),
-    'admin': ('main_title', 'main_desc'),
-    'langs': ('lang_title', 'lang_title'),
-}
-
 @router.callback_query(F.data.startswith("adm:content:screen:"))
 async def cb_content_screen(c: CallbackQuery):
     if not is_admin(c.from_user.id):
@@ -332,14 +423,7 @@ async def cb_content_reset_text(c: CallbackQuery):
     if not is_admin(c.from_user.id):
         return
     _, _, _, lang, screen = c.data.split(":")
-    async with get_session() as session:
-        res = await session.execute(select(ContentOverride).where(
-            ContentOverride.lang == lang, ContentOverride.screen == screen
-        ))
-        ov = res.scalar_one_or_none()
-        if ov:
-            await session.delete(ov)
-            await session.commit()
+    await reset_content(lang, screen)
     await _render_content_screen(c, lang, screen)
     await c.answer("Текст сброшен к дефолту.", show_alert=False)
 
@@ -349,6 +433,7 @@ async def cb_content_reset_photo(c: CallbackQuery):
         return
     _, _, _, lang, screen = c.data.split(":")
     p = Path("assets") / ("ru" if lang == "ru" else "en") / f"{screen}.jpg"
+    await forget_photo(p.parent.name, screen)
     if p.exists():
         try:
             p.unlink()
@@ -386,17 +471,7 @@ async def on_content_text(m: Message, state: FSMContext):
     lang, screen = data["lang"], data["screen"]
     text = m.text or ""
 
-    async with get_session() as session:
-        res = await session.execute(select(ContentOverride).where(
-            ContentOverride.lang == lang, ContentOverride.screen == screen
-        ))
-        ov = res.scalar_one_or_none()
-        if not ov:
-            ov = ContentOverride(lang=lang, screen=screen, text=text)
-            session.add(ov)
-        else:
-            ov.text = text
-        await session.commit()
+    await set_content_text(lang, screen, text)
 
     await m.answer("✅ Текст сохранён. /admin → Контент, чтобы посмотреть.")
     await state.clear()
@@ -424,6 +499,8 @@ async def on_content_photo(m: Message, state: FSMContext):
     path = Path("assets") / (("ru") if lang == "ru" else "en") / f"{screen}.jpg"
     path.parent.mkdir(parents=True, exist_ok=True)
     await m.bot.download(photo, destination=path)
+    # старый file_id больше не соответствует файлу
+    await forget_photo(path.parent.name, screen)
     await m.answer(f"✅ Картинка сохранена: {path}")
     await state.clear()
 
@@ -511,21 +588,28 @@ class BroadcastState(StatesGroup):
     waiting_text = State()
     waiting_photo = State()
 
-BCAST_SEGMENT = {}
+def _bcast_ctx(state: FSMContext) -> FSMContext:
+    # выбранный сегмент — в отдельном destiny: state.clear() после ввода текста его не сбрасывает
+    return FSMContext(storage=state.storage, key=replace(state.key, destiny="bcast"))
+
+
+async def _bcast_segment(state: FSMContext) -> str:
+    return (await _bcast_ctx(state).get_data()).get("segment", "all")
+
 
 @router.callback_query(F.data.startswith("adm:bcast:seg:"))
-async def cb_bcast_seg(c: CallbackQuery):
+async def cb_bcast_seg(c: CallbackQuery, state: FSMContext):
     if not is_admin(c.from_user.id):
         return
     seg = c.data.split(":")[-1]
-    BCAST_SEGMENT[c.from_user.id] = seg
+    await _bcast_ctx(state).update_data(segment=seg)
     await c.answer("Сегмент выбран: " + seg, show_alert=False)
 
 @router.callback_query(F.data == "adm:broadcast")
-async def cb_broadcast(c: CallbackQuery):
+async def cb_broadcast(c: CallbackQuery, state: FSMContext):
     if not is_admin(c.from_user.id):
         return
-    cur = BCAST_SEGMENT.get(c.from_user.id, "all")
+    cur = await _bcast_segment(state)
     await c.message.edit_text(f"📣 Рассылка\nСегмент: {cur}", reply_markup=kb_broadcast())
     await c.answer()
 
@@ -563,59 +647,55 @@ async def on_bcast_photo(m: Message, state: FSMContext):
     await state.clear()
 
 @router.callback_query(F.data == "adm:bcast:go")
-async def cb_bcast_go(c: CallbackQuery):
+async def cb_bcast_go(c: CallbackQuery, state: FSMContext):
     if not is_admin(c.from_user.id):
         return
-    seg = BCAST_SEGMENT.get(c.from_user.id, "all")
-    text = await bcast_text()
-    photo = await bcast_photo()
-    count_ok = 0
-    count_err = 0
-
-    async with get_session() as session:
-        q = select(User).where(User.group_ab == 'A')  # B исключаем
-        if seg == "reg":
-            q = q.where(User.is_registered.is_(True))
-        elif seg == "dep":
-            q = q.where(User.has_deposit.is_(True))
-        elif seg == "start":
-            q = q.where(User.is_registered.is_(False), User.has_deposit.is_(False))
-        res = await session.execute(q)
-        users = res.scalars().all()
-
-    for u in users:
-        try:
-            if photo:
-                await c.bot.send_photo(u.telegram_id, photo=photo, caption=text or None)
-            else:
-                await c.bot.send_message(u.telegram_id, text or "(пусто)")
-            count_ok += 1
-        except Exception:
-            count_err += 1
-        await asyncio.sleep(0.03)
+    seg = await _bcast_segment(state)
+    job = await launch_broadcast(
+        c.bot, admin_id=c.from_user.id, chat_id=c.message.chat.id,
+        segment=seg, text=await bcast_text(), photo=await bcast_photo(),
+    )
+    await c.answer(f"Рассылка #{job.id} запущена", show_alert=False)
 
-    await c.answer(f"Отправлено: {count_ok}, ошибок: {count_err}", show_alert=True)
+@router.callback_query(F.data.startswith("adm:bcast:stop:"))
+async def cb_bcast_stop(c: CallbackQuery):
+    if not is_admin(c.from_user.id):
+        return
+    await stop_broadcast(int(c.data.split(":")[-1]))
+    await c.answer("Останавливаю после текущей пачки…", show_alert=False)
 
 
 # --- stats (only group A)
+def _stats_text(report: dict) -> str:
+    lines = [
+        "📊 <b>Статистика</b>",
+        "<i>юзеры · подписка · рега · депозит · платинум</i>\n",
+        f"Всего: <b>{report['total'].line()}</b>\n",
+        "<b>По языкам</b>",
+    ]
+    for lang, f in sorted(report["by_lang"].items()):
+        lines.append(f"{lang.upper()}: {f.line()}")
+    lines.append("\n<b>По дням прихода</b>")
+    for day, f in report["by_day"].items():
+        lines.append(f"{day:%d.%m}: {f.line()}")
+    lines.append("\n<b>По неделям прихода</b>")
+    for week, f in report["by_week"].items():
+        lines.append(f"с {week:%d.%m}: {f.line()}")
+    return "\n".join(lines)
+
+
 @router.callback_query(F.data == "adm:stats")
 async def cb_stats(c: CallbackQuery):
     if not is_admin(c.from_user.id):
         return
-    async with get_session() as session:
-        total_a = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A'))
-        subs_a  = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A', User.is_subscribed.is_(True)))
-        regs_a  = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A', User.is_registered.is_(True)))
-        deps_a  = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A', User.has_deposit.is_(True)))
-        plats_a = await session.scalar(select(func.count(User.id)).where(User.group_ab == 'A', User.is_platinum.is_(True)))
-
-    text = (
-        "📊 <b>Статистика</b>\n\n"
-        f"Юзеров: {total_a}\n"
-        f"Подписались: {subs_a}\n"
-        f"С регой: {regs_a}\n"
-        f"С депозитом: {deps_a}\n"
-        f"Платинум: {plats_a}"
-    )
-    await c.message.edit_text(text, reply_markup=kb_admin_menu(), parse_mode='HTML')
+    report = await funnel_report("A")
+    await c.message.edit_text(_stats_text(report), reply_markup=kb_stats(), parse_mode='HTML')
     await c.answer()
+
+
+@router.callback_query(F.data == "adm:stats:rebuild")
+async def cb_stats_rebuild(c: CallbackQuery):
+    if not is_admin(c.from_user.id):
+        return
+    await rebuild_stats()
+    await cb_stats(c)
@@ -1,10 +1,11 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from typing import Iterable, Tuple, List
+from typing import Iterable, Tuple, List, Optional
 
 # -------- Меню --------
 def kb_admin_menu() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text='👤 Пользователи', callback_data='adm:users:1')],
+        [InlineKeyboardButton(text='👤 Пользователи', callback_data='adm:users:1'),
+         InlineKeyboardButton(text='🔎 Поиск', callback_data='adm:search')],
         [InlineKeyboardButton(text='✏️ Настройка постбэков', callback_data='adm:postbacks')],
         [InlineKeyboardButton(text='🧩 Контент', callback_data='adm:content'),
          InlineKeyboardButton(text='🔗 Ссылки', callback_data='adm:links')],
@@ -21,12 +22,12 @@ def kb_back_menu() -> InlineKeyboardMarkup:
 # -------- Пользователи --------
 def kb_users_list(
     items: Iterable[Tuple[int, str]],
-    page: int,
-    has_prev: bool,
-    has_next: bool
+    prev_cursor: Optional[int],
+    next_cursor: Optional[int]
 ) -> InlineKeyboardMarkup:
     """
     items: Iterable[Tuple[int, str]]  # (tg_id, подпись)
+    prev_cursor / next_cursor: users.id границ страницы (keyset), None — кнопки нет
     ВНИМАНИЕ: сюда уже передаём список БЕЗ пользователей группы B
     """
     rows: List[List[InlineKeyboardButton]] = []
@@ -34,10 +35,10 @@ def kb_users_list(
         rows.append([InlineKeyboardButton(text=label, callback_data=f'adm:user:{tg_id}')])
 
     nav: List[InlineKeyboardButton] = []
-    if has_prev:
-        nav.append(InlineKeyboardButton(text='◀️', callback_data=f'adm:users:{page-1}'))
-    if has_next:
-        nav.append(InlineKeyboardButton(text='▶️', callback_data=f'adm:users:{page+1}'))
+    if prev_cursor is not None:
+        nav.append(InlineKeyboardButton(text='◀️', callback_data=f'adm:users:b:{prev_cursor}'))
+    if next_cursor is not None:
+        nav.append(InlineKeyboardButton(text='▶️', callback_data=f'adm:users:a:{next_cursor}'))
     if nav:
         rows.append(nav)
     rows.append([InlineKeyboardButton(text='🏠 В меню', callback_data='adm:menu')])
@@ -150,6 +151,20 @@ def kb_broadcast() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text='🏠 В меню', callback_data='adm:menu')],
     ])
 
+def kb_bcast_progress(job_id: int, running: bool) -> InlineKeyboardMarkup:
+    rows = []
+    if running:
+        rows.append([InlineKeyboardButton(text='⏹ Остановить', callback_data=f'adm:bcast:stop:{job_id}')])
+    rows.append([InlineKeyboardButton(text='🏠 В меню', callback_data='adm:menu')])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+# -------- Статистика --------
+def kb_stats() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text='🔄 Пересчитать', callback_data='adm:stats:rebuild')],
+        [InlineKeyboardButton(text='🏠 В меню', callback_data='adm:menu')],
+    ])
+
 def kb_number_back(back_cb: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text='↩️ Отмена', callback_data=back_cb)]
@@ -0,0 +1,155 @@
+"""
+Локальная заглушка Bot API для нагрузочных прогонов (бот ходит сюда через BOT_API_URL).
+
+Отвечает правдоподобными объектами на send*/edit*/getChatMember и True на всё остальное,
+считает вызовы по методам, умеет добавлять задержку и отвечать 429 (retry_after),
+как Telegram при флуде.
+
+    python -m bench.fake_api --port 8081 --latency 40 --flood 0.01
+
+GET /stats — счётчики вызовов, GET /reset — обнулить.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import random
+import socket
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+SEND_PREFIXES = ("send", "edit", "copy", "forward")
+
+
+def free_port(host: str = "127.0.0.1") -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0.0, flood: float = 0.0, retry_after: int = 1,
+                 member_status: str = "member"):
+        self.latency = latency_ms / 1000
+        self.flood = flood
+        self.retry_after = retry_after
+        self.member_status = member_status
+        self.calls: Counter = Counter()
+        self.floods: Counter = Counter()
+        self.screens: Dict[int, Dict[str, Any]] = {}  # chat_id -> последнее отправленное сообщение
+        self._ids = itertools.count(1000)
+
+    def reset(self) -> None:
+        self.calls.clear()
+        self.floods.clear()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.stats)
+        app.router.add_get("/reset", self._reset)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        self.port = port or free_port(host)
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, self.port).start()
+        return runner
+
+    # ---- handlers ----
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data: Dict[str, Any] = await request.json()
+        else:
+            data = dict(await request.post())
+        self.calls[method] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        if self.flood and method.lower().startswith(SEND_PREFIXES) and random.random() < self.flood:
+            self.floods[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        return web.json_response({"ok": True, "result": self.result(method, data)})
+
+    async def stats(self, _: web.Request) -> web.Response:
+        return web.json_response(self.snapshot())
+
+    async def _reset(self, _: web.Request) -> web.Response:
+        self.reset()
+        return web.json_response({"ok": True})
+
+    # ---- ответы ----
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"calls": dict(self.calls), "floods": dict(self.floods)}
+
+    def _message(self, data: Dict[str, Any], message_id: Optional[int] = None) -> Dict[str, Any]:
+        chat_id = int(data.get("chat_id") or 0)
+        msg = {
+            "message_id": message_id or next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+        }
+        if data.get("text"):
+            msg["text"] = data["text"]
+        return msg
+
+    def result(self, method: str, data: Dict[str, Any]) -> Any:
+        if method in ("sendMessage", "sendPhoto", "copyMessage", "forwardMessage"):
+            msg = self._message(data)
+            if method == "sendPhoto":
+                msg["photo"] = [{"file_id": f"bench-{msg['message_id']}", "file_unique_id": "bench",
+                                 "width": 1, "height": 1}]
+            self.screens[msg["chat"]["id"]] = msg
+            if method == "copyMessage":
+                return {"message_id": msg["message_id"]}
+            return msg
+        if method.startswith("editMessage"):
+            if data.get("inline_message_id"):
+                return True
+            msg = self._message(data, int(data.get("message_id") or 0) or None)
+            screen = self.screens.get(msg["chat"]["id"])
+            if screen and screen["message_id"] == msg["message_id"]:
+                msg = {**screen, **{k: v for k, v in msg.items() if k != "text"}}
+            return msg
+        if method == "getChatMember":
+            user = {"id": int(data.get("user_id") or 0), "is_bot": False, "first_name": "bench"}
+            return {"status": self.member_status, "user": user}
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            return []
+        return True
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    api = FakeBotAPI(args.latency, args.flood, args.retry_after, args.member_status)
+    await api.start(args.host, args.port)
+    print(f"fake Bot API on http://{args.host}:{api.port}  (BOT_API_URL)")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean latency per call, ms")
+    parser.add_argument("--flood", type=float, default=0.0, help="share of send/edit calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--member-status", default="member", help="getChatMember status (member/left)")
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,340 @@
+"""
+Нагрузочный прогон бота и postback_app без Telegram и без партнёрки.
+
+    python -m bench.run flows --users 500 --concurrency 50 --latency 40
+    python -m bench.run pb --users 1000 --concurrency 100 --repeats 3
+    python -m bench.run all --json bench_result.json
+
+- flows: пользователи проходят /start → выбор языка → get_signal → check_sub; апдейты идут
+  прямо в Dispatcher (как из polling/webhook), Bot API — локальная заглушка (fake_api.py);
+- pb: postback_app поднимается в этом же процессе (uvicorn), по нему бьют пачки GET /pb
+  reg → dep_first → dep_repeat×N, пуши outbox уходят в ту же заглушку.
+
+По каждому шагу — p50/p95/p99/max задержки, SQL-запросов на апдейт/запрос и пропускная
+способность. База всегда отдельная (--db, по умолчанию временный SQLite-файл), боевую
+DATABASE_URL и токен из .env прогон не трогает.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+BENCH_TOKEN = "123456:BENCH-BENCH-BENCH-BENCH-BENCH-BENCH"
+BENCH_SECRET = "bench-secret"
+USER_ID_BASE = 7_000_000_000
+
+FLOW = [
+    ("start", {"text": "/start"}),
+    ("setlang", {"data": "setlang:ru"}),
+    ("get_signal", {"data": "get_signal"}),
+    ("check_sub", {"data": "check_sub"}),
+]
+
+
+def configure(db_url: str, api_url: str, concurrency: int) -> None:
+    """Окружение до импорта settings: своя база, заглушка Bot API, без фоновых задач."""
+    os.environ.update({
+        "DATABASE_URL": db_url,
+        "TOKEN_BOT": BENCH_TOKEN,
+        "BOT_API_URL": api_url,
+        "BOT_MODE": "polling",
+        "BACKGROUND_TASKS": "0",
+        "PB_SECRET": BENCH_SECRET,
+        "PUBLIC_BASE": "http://bench.local",
+        "CHANNEL_ID": os.environ.get("BENCH_CHANNEL_ID", "-1001000000000"),
+        "FSM_STORAGE": "memory",
+    })
+    os.environ.setdefault("SEND_CONCURRENCY", str(max(32, concurrency)))
+    sys.path.insert(0, str(ROOT))
+
+
+# ========= статистика =========
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class Recorder:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.queries: Dict[str, List[float]] = defaultdict(list)
+        self.status: Dict[str, Counter] = defaultdict(Counter)
+        self.wall: Dict[str, float] = {}
+
+    def add(self, step: str, seconds: float, queries: Optional[float] = None, status: Any = None) -> None:
+        self.latency[step].append(seconds)
+        if queries is not None:
+            self.queries[step].append(queries)
+        if status is not None:
+            self.status[step][str(status)] += 1
+
+    def rows(self) -> List[Dict[str, Any]]:
+        out = []
+        for step, values in self.latency.items():
+            q = self.queries.get(step)
+            wall = self.wall.get(step)
+            out.append({
+                "step": step,
+                "n": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(max(values) * 1000, 1),
+                "queries": round(sum(q) / len(q), 2) if q else None,
+                "rps": round(len(values) / wall, 1) if wall else None,
+                "status": dict(self.status[step]) or None,
+            })
+        return out
+
+
+def print_rows(title: str, rows: List[Dict[str, Any]]) -> None:
+    print(f"\n== {title}")
+    print(f"{'step':<12} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} "
+          f"{'SQL/op':>7} {'op/s':>7}  status")
+    for r in rows:
+        q = "-" if r["queries"] is None else f"{r['queries']:.2f}"
+        rps = "-" if r["rps"] is None else f"{r['rps']:.1f}"
+        status = " ".join(f"{k}:{v}" for k, v in (r["status"] or {}).items())
+        print(f"{r['step']:<12} {r['n']:>6} {r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8} "
+              f"{r['max_ms']:>8} {q:>7} {rps:>7}  {status}")
+
+
+def count_statements() -> List[int]:
+    """Счётчик всех SQL-выражений процесса (включая очередь записи и outbox)."""
+    from sqlalchemy import event
+    from db import engine
+
+    total = [0]
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _count(*_):
+        total[0] += 1
+
+    return total
+
+
+# ========= сценарий бота =========
+
+def _update(update_id: int, uid: int, text: Optional[str] = None, data: Optional[str] = None,
+            screen: Optional[dict] = None) -> dict:
+    """Апдейт от пользователя; кнопка нажимается на последнем экране, который ему прислал бот."""
+    user = {"id": uid, "is_bot": False, "first_name": "bench", "language_code": "ru"}
+    msg = {"message_id": update_id, "date": int(time.time()), "chat": {"id": uid, "type": "private"}}
+    if text is not None:
+        return {"update_id": update_id, "message": {**msg, "from": user, "text": text}}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user, "chat_instance": "bench", "data": data,
+        "message": {**(screen or {**msg, "text": "screen"}),
+                    "from": {"id": 123456, "is_bot": True, "first_name": "bench"}},
+    }}
+
+
+async def run_flows(args: argparse.Namespace, rec: Recorder, api) -> None:
+    from aiogram.types import Update
+    from bot import create_bot, build_dispatcher, prepare
+    from db import query_counter
+
+    bot = create_bot()
+    dp = build_dispatcher()
+    await prepare(bot)
+
+    # внутренний outer-middleware: видит счётчик, который выставил QueryCounterMiddleware
+    per_update: Dict[int, int] = {}
+
+    async def remember_queries(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            counter = query_counter.get()
+            per_update[event.update_id] = counter[0] if counter else 0
+
+    dp.update.outer_middleware(remember_queries)
+
+    ids = itertools.count(1)
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one_user(i: int) -> None:
+        uid = USER_ID_BASE + i
+        async with sem:
+            for step, payload in FLOW:
+                update_id = next(ids)
+                raw = _update(update_id, uid, screen=api.screens.get(uid), **payload)
+                update = Update.model_validate(raw, context={"bot": bot})
+                started = time.perf_counter()
+                try:
+                    await dp.feed_update(bot, update)
+                    status = "ok"
+                except Exception as e:
+                    status = type(e).__name__
+                rec.add(step, time.perf_counter() - started, per_update.pop(update_id, None), status)
+                if args.think:
+                    await asyncio.sleep(args.think / 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_user(i) for i in range(args.users)))
+    wall = time.perf_counter() - started
+    # апдейты шагов идут вперемешку — op/s по шагу считаем от общего времени прогона
+    for step, _ in FLOW:
+        rec.wall[step] = wall
+    print(f"flows: {args.users} users, {args.users * len(FLOW)} updates in {wall:.1f}s "
+          f"→ {args.users * len(FLOW) / wall:.1f} updates/s")
+    await bot.session.close()
+
+
+# ========= постбэки =========
+
+async def _seed_users(n: int) -> List[str]:
+    from sqlalchemy import select
+    from db import get_session, init_db, gen_click_id, dialect_insert, User
+
+    await init_db()
+    rows = [{"telegram_id": USER_ID_BASE + 500_000 + i, "click_id": gen_click_id(),
+             "group_ab": "A" if i % 2 else "B", "language": "ru"} for i in range(n)]
+    async with get_session() as s:
+        for i in range(0, n, 500):
+            await s.execute(dialect_insert(User).values(rows[i:i + 500])
+                            .on_conflict_do_nothing(index_elements=[User.telegram_id]))
+        await s.commit()
+        tg_ids = [r["telegram_id"] for r in rows]
+        found = await s.execute(select(User.telegram_id, User.click_id).where(User.telegram_id.in_(tg_ids)))
+        by_tg = dict(found.all())
+    return [by_tg[t] for t in tg_ids]
+
+
+async def _outbox_pending() -> int:
+    from sqlalchemy import select, func
+    from db import get_session, OutboxJob
+
+    async with get_session() as s:
+        return await s.scalar(select(func.count()).select_from(OutboxJob).where(OutboxJob.status == "pending"))
+
+
+async def run_postbacks(args: argparse.Namespace, rec: Recorder) -> None:
+    import aiohttp
+    import uvicorn
+    from bench.fake_api import free_port
+
+    click_ids = await _seed_users(args.users)
+    statements = count_statements()
+
+    import postback_app
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(postback_app.app, host="127.0.0.1", port=port,
+                                           log_level="warning", access_log=False))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    base = f"http://127.0.0.1:{port}/pb"
+    sem = asyncio.Semaphore(args.concurrency)
+    phases = [("reg", [{"event": "reg", "click_id": c, "trader_id": f"T{i}"} for i, c in enumerate(click_ids)]),
+              ("dep_first", [{"event": "dep_first", "click_id": c, "sumdep": "50", "tx_id": f"{c}-0"}
+                             for c in click_ids])]
+    for r in range(1, args.repeats + 1):
+        phases.append(("dep_repeat", [{"event": "dep_repeat", "click_id": c, "sumdep": "25.5",
+                                        "tx_id": f"{c}-{r}"} for c in click_ids]))
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        async def fire(step: str, params: Dict[str, str]) -> None:
+            async with sem:
+                started = time.perf_counter()
+                async with http.get(base, params={**params, "t": BENCH_SECRET}) as resp:
+                    await resp.read()
+                rec.add(step, time.perf_counter() - started, status=resp.status)
+
+        for step, batch in phases:
+            before = statements[0]
+            started = time.perf_counter()
+            await asyncio.gather(*(fire(step, p) for p in batch))
+            rec.wall[step] = rec.wall.get(step, 0.0) + time.perf_counter() - started
+            # SQL на запрос — по всему процессу: запись идёт через общую очередь (writequeue.py)
+            rec.queries[step].append((statements[0] - before) / len(batch))
+
+        started = time.perf_counter()
+        while await _outbox_pending() and time.perf_counter() - started < args.drain:
+            await asyncio.sleep(0.2)
+        left = await _outbox_pending()
+        print(f"postbacks: outbox drained in {time.perf_counter() - started:.1f}s"
+              + (f", {left} jobs still pending" if left else ""))
+
+    server.should_exit = True
+    await serving
+
+
+# ========= entry =========
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    from bench.fake_api import FakeBotAPI
+
+    api = FakeBotAPI(args.latency, args.flood, args.retry_after)
+    runner = await api.start()
+    configure(args.db, f"http://127.0.0.1:{api.port}", args.concurrency)
+
+    result: Dict[str, Any] = {"args": vars(args)}
+    try:
+        if args.mode in ("flows", "all"):
+            rec = Recorder()
+            await run_flows(args, rec, api)
+            result["flows"] = rec.rows()
+            print_rows("bot flows (per update)", result["flows"])
+        if args.mode in ("pb", "all"):
+            rec = Recorder()
+            await run_postbacks(args, rec)
+            result["postbacks"] = rec.rows()
+            print_rows("postbacks (per request, SQL per request across the process)", result["postbacks"])
+    finally:
+        await runner.cleanup()
+
+    from sender import send_stats
+    result["bot_api"] = api.snapshot()
+    result["send"] = send_stats()
+    print(f"\nBot API calls: {dict(api.calls)}")
+    if api.floods:
+        print(f"429 injected:  {dict(api.floods)}")
+    print(f"sender:        {result['send']}")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PocketAI load test against a fake Bot API")
+    parser.add_argument("mode", choices=["flows", "pb", "all"])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=2, help="dep_repeat rounds per user (pb)")
+    parser.add_argument("--think", type=float, default=0.0, help="pause between a user's steps, ms")
+    parser.add_argument("--latency", type=float, default=30.0, help="fake Bot API latency, ms")
+    parser.add_argument("--flood", type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--drain", type=float, default=60.0, help="max wait for outbox pushes, s")
+    parser.add_argument("--db", default=None, help="DATABASE_URL for the run (default: fresh temp SQLite)")
+    parser.add_argument("--json", default=None, help="write results to this file")
+    args = parser.parse_args()
+
+    tmp = None
+    if not args.db:
+        tmp = tempfile.TemporaryDirectory(prefix="pocketai-bench-")
+        args.db = f"sqlite+aiosqlite:///{tmp.name}/bench.db"
+    try:
+        out = asyncio.run(main(args))
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    if args.json:
+        Path(args.json).write_text(json.dumps(out, ensure_ascii=False, indent=2))
@@ -1,31 +1,41 @@
 import asyncio
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Optional
-import hmac, hashlib
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramForbiddenError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.types import Message, CallbackQuery, InputMediaPhoto
 
-from sqlalchemy import select, func
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from settings import settings
-from db import (
-    init_db, get_session, get_or_create_user, User,
-    ensure_click_id, ContentOverride
-)
-from texts import t
+from db import init_db, get_session, User, ensure_click_id
+from middlewares import DbSessionMiddleware, QueryCounterMiddleware
+from texts import t, LANGS
 from keyboards import (
     kb_main, kb_instruction, kb_lang, kb_subscribe,
     kb_register, kb_deposit, kb_access
 )
-from admin import router as admin_router
+from admin import router as admin_router, is_admin
+from fsm_storage import build_storage
+from media_cache import photo_input, remember_photo, forget_path, load_media_cache
+from broadcast import resume_broadcasts
+from stats import ensure_stats
+from links import short_link
+from subscriptions import check_subscription, start_sweeper
+from sender import install as install_sender, schedule_delete
+from metrics import STEP_SECONDS, start_metrics_server
+from tracing import install as install_tracing, update_middleware as trace_updates
 from config_service import (
-    pb_secret, channel_id,
     first_deposit_min, platinum_threshold,
-    check_subscription_enabled, load_button_overrides, check_registration_enabled, check_deposit_enabled
+    check_subscription_enabled, check_registration_enabled, check_deposit_enabled,
+    load_config, screen_content,
 )
 
 ASSETS = Path(__file__).parent / "assets"
@@ -46,11 +56,6 @@ def user_lang(user: User) -> str:
     return user.language or DEFAULT_LANG
 
 
-async def make_sig(kind: str, click_id: str) -> str:
-    secret = await pb_secret()
-    return hmac.new(secret.encode(), f"{kind}:{click_id}".encode(), hashlib.sha256).hexdigest()
-
-
 def photo_path(lang: Optional[str], key: str) -> Optional[Path]:
     subdir = 'ru' if (lang == 'ru') else 'en'
     for base in (ASSETS.parent / 'assets_custom', ASSETS):
@@ -58,87 +63,127 @@ def photo_path(lang: Optional[str], key: str) -> Optional[Path]:
         try:
             if p.exists() and p.stat().st_size > 0:
                 return p
-        except Exception:
+        except OSError:
             pass
     return None
 
 
 
 
-async def delete_previous(bot: Bot, chat_id: int, user: User) -> None:
+def delete_previous(bot: Bot, chat_id: int, user: User) -> None:
+    """Старый экран удаляется в фоне (sender.DeleteQueue), новый его не ждёт."""
     if user.last_bot_message_id:
-        try:
-            await bot.delete_message(chat_id, user.last_bot_message_id)
-        except Exception:
-            pass
+        schedule_delete(bot, chat_id, user.last_bot_message_id)
+
+
+@asynccontextmanager
+async def _user_scope(user: User, session: Optional[AsyncSession]):
+    """
+    Сессия и пользователь для отправки экрана: берём сессию апдейта, если её передали,
+    иначе (пуши из postback_app) открываем свою.
+    """
+    if session is not None:
+        yield session, user
+        return
+    async with get_session() as own:
+        yield own, await own.get(User, user.id)
+
+
+async def _edit_in_place(bot: Bot, u: User, message: Optional[Message], img: Optional[Path],
+                         caption: str, markup, session: AsyncSession) -> bool:
+    """
+    Переход по кнопке: правим текущий экран вместо delete+send, если тип сообщения совпадает
+    (фото -> фото через editMessageMedia, текст -> текст). False — нужно слать новое.
+    """
+    if not isinstance(message, Message) or message.message_id != u.last_bot_message_id:
+        return False
+    try:
+        if img is not None and message.photo:
+            msg = await bot.edit_message_media(
+                media=InputMediaPhoto(media=await photo_input(img), caption=caption, parse_mode="HTML"),
+                chat_id=u.telegram_id, message_id=message.message_id, reply_markup=markup,
+            )
+            if isinstance(msg, Message):
+                await remember_photo(img, msg, session)
+        elif img is None and message.text:
+            await bot.edit_message_text(
+                text=caption, chat_id=u.telegram_id, message_id=message.message_id,
+                parse_mode="HTML", reply_markup=markup,
+            )
+        else:
+            return False
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return True  # тот же экран — уже показан
+        if img is not None:
+            await forget_path(img, session)
+        return False
+    return True
 
 
-async def send_screen(bot: Bot, user: User, key: str, title_key: str, text_key: str, markup) -> None:
-    """Единая отправка экрана с авто-удалением предыдущего и учётом оверрайдов из админки."""
-    async with get_session() as session:
-        db_user = await session.get(User, user.id)
-        await delete_previous(bot, db_user.telegram_id, db_user)
+async def _show(bot: Bot, u: User, img: Optional[Path], caption: str, markup,
+                session: AsyncSession, message: Optional[Message] = None) -> None:
+    """Показывает экран: правка на месте, иначе новое сообщение + фоновое удаление старого."""
+    # не держим соединение пула (и write-lock SQLite), пока ждём лимитер и ответ Bot API
+    await session.commit()
+    if await _edit_in_place(bot, u, message, img, caption, markup, session):
+        await session.commit()
+        return
 
-        lang = user_lang(db_user)
-        img = photo_path(lang, key)
+    try:
+        if img is not None:
+            msg = await bot.send_photo(
+                chat_id=u.telegram_id, photo=await photo_input(img),
+                caption=caption, parse_mode="HTML", reply_markup=markup
+            )
+            await remember_photo(img, msg, session)
+        else:
+            msg = await bot.send_message(
+                chat_id=u.telegram_id, text=caption,
+                parse_mode="HTML", reply_markup=markup
+            )
+    except TelegramBadRequest:
+        # file_id мог протухнуть — в следующий раз загрузим файл заново
+        if img is not None:
+            await forget_path(img, session)
+        # фолбэк в текст; flood wait сюда не попадает — его разруливает sender
+        msg = await bot.send_message(
+            chat_id=u.telegram_id, text=caption,
+            parse_mode="HTML", reply_markup=markup
+        )
 
-        # базовые тексты
-        title = t(lang, title_key)
-        body = t(lang, text_key)
+    delete_previous(bot, u.telegram_id, u)
+    u.last_bot_message_id = msg.message_id
+    await session.commit()
 
-        # оверрайды
-        res = await session.execute(
-            select(ContentOverride).where(ContentOverride.lang == lang, ContentOverride.screen == key)
-        )
-        ov = res.scalar_one_or_none()
-        if ov:
-            title = ov.title or title
-            body = ov.text or body
 
-        caption = f"<b>{title}</b>\n\n{body}"
-        use_photo = (img is not None) and (len(caption) <= 1024)
+@STEP_SECONDS.timed(step="send_screen")
+async def send_screen(bot: Bot, user: User, key: str, title_key: str, text_key: str, markup,
+                      session: Optional[AsyncSession] = None, message: Optional[Message] = None) -> None:
+    """
+    Единая отправка экрана с учётом оверрайдов из админки.
+    message — сообщение с нажатой кнопкой (c.message): тогда экран по возможности правится на месте.
+    """
+    async with _user_scope(user, session) as (session, db_user):
+        lang = user_lang(db_user)
+        img = photo_path(lang, key)
 
-        try:
-            if use_photo:
-                msg = await bot.send_photo(
-                    chat_id=db_user.telegram_id, photo=FSInputFile(img),
-                    caption=caption, parse_mode="HTML", reply_markup=markup
-                )
-            else:
-                msg = await bot.send_message(
-                    chat_id=db_user.telegram_id, text=caption,
-                    parse_mode="HTML", reply_markup=markup
-                )
-        except Exception:
-            # на всякий случай фолбэк в текст
-            msg = await bot.send_message(
-                chat_id=db_user.telegram_id, text=caption,
-                parse_mode="HTML", reply_markup=markup
-            )
+        # тексты с учётом оверрайдов — из кэша, без запроса в БД
+        content = await screen_content(lang, key, title_key, text_key)
+        if not content.fits_photo:
+            img = None
 
-        db_user.last_bot_message_id = msg.message_id
-        await session.commit()
+        await _show(bot, db_user, img, content.caption, markup, session, message)
 
-async def send_deposit_progress(bot: Bot, user: User) -> None:
-    """Экран депозита + динамический прогресс (нужная сумма / внесено / осталось)."""
-    async with get_session() as session:
-        u = await session.get(User, user.id)
-        await delete_previous(bot, u.telegram_id, u)
 
+async def send_deposit_progress(bot: Bot, user: User, session: Optional[AsyncSession] = None,
+                                message: Optional[Message] = None) -> None:
+    """Экран депозита + динамический прогресс (нужная сумма / внесено / осталось)."""
+    async with _user_scope(user, session) as (session, u):
         lang = u.language or DEFAULT_LANG
         # картинка и базовые тексты (с оверрайдом из БД, если есть)
         p = photo_path(lang, "deposit")
-        title = t(lang, "deposit_title")
-        body  = t(lang, "deposit_text")
-
-        ov = None
-        res = await session.execute(
-            select(ContentOverride).where(ContentOverride.lang == lang, ContentOverride.screen == "deposit")
-        )
-        ov = res.scalar_one_or_none()
-        if ov:
-            title = ov.title or title
-            body  = ov.text  or body
+        content = await screen_content(lang, "deposit", "deposit_title", "deposit_text")
 
         # прогресс
         need = await first_deposit_min()
@@ -154,45 +199,25 @@ async def send_deposit_progress(bot: Bot, user: User) -> None:
 
         # кнопка
         u = await ensure_click_id(session, u)
-        dep_url = f"{settings.PUBLIC_BASE.rstrip('/')}/d/{u.click_id}/{await make_sig('dep', u.click_id)}"
+        dep_url = await short_link('dep', u.click_id)
         markup = kb_deposit(lang, dep_url)
 
         # отправка
-        caption = f"<b>{title}</b>\n\n{body}{extra}"
-        use_photo = (p is not None) and (len(caption) <= 1024)
+        caption = f"{content.caption}{extra}"
+        if len(caption) > 1024:
+            p = None
 
-        try:
-            if use_photo:
-                msg = await bot.send_photo(u.telegram_id, FSInputFile(p),
-                                           caption=caption, parse_mode="HTML", reply_markup=markup)
-            else:
-                msg = await bot.send_message(u.telegram_id, caption, parse_mode="HTML", reply_markup=markup)
-        except Exception:
-            msg = await bot.send_message(u.telegram_id, caption, parse_mode="HTML", reply_markup=markup)
-
-        u.last_bot_message_id = msg.message_id
-        await session.commit()
-
-async def check_subscription(bot: Bot, tg_id: int) -> bool:
-    try:
-        cid = await channel_id()
-        member = await bot.get_chat_member(cid, tg_id)
-        status = getattr(member, "status", None)
-        return status in {"member", "administrator", "creator"}
-    except TelegramForbiddenError:
-        return False
-    except Exception:
-        return False
+        await _show(bot, u, p, caption, markup, session, message)
 
 
-async def evaluate_and_route(bot: Bot, user: User) -> None:
-    """Показывает следующий актуальный экран по воронке."""
-    async with get_session() as session:
-        u = await session.get(User, user.id)
+@STEP_SECONDS.timed(step="evaluate_and_route")
+async def evaluate_and_route(bot: Bot, user: User, session: Optional[AsyncSession] = None,
+                             message: Optional[Message] = None) -> None:
+    """Показывает следующий актуальный экран по воронке (message — см. send_screen)."""
+    async with _user_scope(user, session) as (session, u):
 
-        # авто-обновление подписки
-        is_sub = await check_subscription(bot, u.telegram_id)
-        if is_sub and not u.is_subscribed:
+        # авто-обновление подписки (из кэша; отписки ловит фоновый sweeper)
+        if not u.is_subscribed and await check_subscription(bot, u.telegram_id):
             u.is_subscribed = True
             await session.commit()
 
@@ -202,7 +227,7 @@ async def evaluate_and_route(bot: Bot, user: User) -> None:
                 await send_screen(
                     bot, u, key="subscribe",
                     title_key="subscribe_title", text_key="subscribe_text",
-                    markup=kb_subscribe(user_lang(u))
+                    markup=kb_subscribe(user_lang(u)), session=session, message=message
                 )
                 return
 
@@ -210,20 +235,18 @@ async def evaluate_and_route(bot: Bot, user: User) -> None:
         if await check_registration_enabled():
             if not u.is_registered:
                 u = await ensure_click_id(session, u)
-                reg_url = f"{settings.PUBLIC_BASE.rstrip('/')}/r/{u.click_id}/{await make_sig('reg', u.click_id)}"
+                reg_url = await short_link('reg', u.click_id)
                 await send_screen(
                     bot, u, key="register",
                     title_key="register_title", text_key="register_text",
-                    markup=kb_register(user_lang(u), reg_url)
+                    markup=kb_register(user_lang(u), reg_url), session=session, message=message
                 )
                 return
 
         # 3) Депозит
         if await check_deposit_enabled():
             if not u.has_deposit:
-                u = await ensure_click_id(session, u)
-                dep_url = f"{settings.PUBLIC_BASE.rstrip('/')}/d/{u.click_id}/{await make_sig('dep', u.click_id)}"
-                await send_deposit_progress(bot, u)
+                await send_deposit_progress(bot, u, session=session, message=message)
                 return
 
         # Platinum (защита от расхождений с постбэком)
@@ -239,173 +262,204 @@ async def evaluate_and_route(bot: Bot, user: User) -> None:
             await send_screen(
                 bot, u, key="access",
                 title_key="access_title", text_key="access_text",
-                markup=kb_access(user_lang(u), vip=u.is_platinum)
+                markup=kb_access(user_lang(u), vip=u.is_platinum), session=session, message=message
             )
             return
 
 
 # ----------------- router -----------------
+# session и user приходят из DbSessionMiddleware: одна сессия и один SELECT юзера на апдейт
 router = Router()
+router.message.middleware(DbSessionMiddleware())
+router.callback_query.middleware(DbSessionMiddleware())
 
 
 @router.message(Command("start"))
-async def cmd_start(m: Message, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, m.from_user.id)
-        if not user.language:
-            await send_screen(bot, user, key='langs',
-                              title_key='lang_title', text_key='lang_title',
-                              markup=kb_lang(user_lang(user)))
-            return
-        can_open = await has_access_now(user)
-        await send_screen(bot, user, key='main',
-                          title_key='main_title', text_key='main_desc',
-                          markup=kb_main(user_lang(user), user.is_platinum, can_open))
+async def cmd_start(m: Message, bot: Bot, session: AsyncSession, user: User):
+    if not user.language:
+        await send_screen(bot, user, key='langs',
+                          title_key='lang_title', text_key='lang_title',
+                          markup=kb_lang(user_lang(user)), session=session)
+        return
+    can_open = await has_access_now(user)
+    await send_screen(bot, user, key='main',
+                      title_key='main_title', text_key='main_desc',
+                      markup=kb_main(user_lang(user), user.is_platinum, can_open), session=session)
 
 
 
 @router.callback_query(F.data == 'menu')
-async def cb_menu_user(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        can_open = await has_access_now(user)
-        await send_screen(bot, user, key='main',
-                          title_key='main_title', text_key='main_desc',
-                          markup=kb_main(user_lang(user), user.is_platinum, can_open))
+async def cb_menu_user(c: CallbackQuery, bot: Bot, session: AsyncSession, user: User):
+    can_open = await has_access_now(user)
+    await send_screen(bot, user, key='main',
+                      title_key='main_title', text_key='main_desc',
+                      markup=kb_main(user_lang(user), user.is_platinum, can_open),
+                      session=session, message=c.message)
     await c.answer()
 
 
 
 @router.callback_query(F.data == "instructions")
-async def cb_instructions(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        await send_screen(
-            bot, user, key="instruction",
-            title_key="instruction_title", text_key="instruction_text",
-            markup=kb_instruction(user_lang(user))
-        )
+async def cb_instructions(c: CallbackQuery, bot: Bot, session: AsyncSession, user: User):
+    await send_screen(
+        bot, user, key="instruction",
+        title_key="instruction_title", text_key="instruction_text",
+        markup=kb_instruction(user_lang(user)), session=session, message=c.message
+    )
     await c.answer()
 
 
 @router.callback_query(F.data == "lang")
-async def cb_lang(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        await send_screen(
-            bot, user, key="langs",
-            title_key="lang_title", text_key="lang_title",
-            markup=kb_lang(user_lang(user))
-        )
+async def cb_lang(c: CallbackQuery, bot: Bot, session: AsyncSession, user: User):
+    await send_screen(
+        bot, user, key="langs",
+        title_key="lang_title", text_key="lang_title",
+        markup=kb_lang(user_lang(user)), session=session, message=c.message
+    )
     await c.answer()
 
 
 @router.callback_query(F.data.startswith("setlang:"))
-async def cb_setlang(c: CallbackQuery, bot: Bot):
+async def cb_setlang(c: CallbackQuery, bot: Bot, session: AsyncSession, user: User):
     lang = c.data.split(":", 1)[1]
-    if lang not in {"ru", "en", "hi", "es"}:
+    if lang not in LANGS:
         lang = DEFAULT_LANG
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        user.language = lang
-        await session.commit()
-
-        can_open = await has_access_now(user)
-        await send_screen(
-            bot, user, key="main",
-            title_key="main_title", text_key="main_desc",
-            markup=kb_main(user_lang(user), user.is_platinum, can_open)
-        )
+    user.language = lang
+
+    can_open = await has_access_now(user)
+    # язык закоммитится внутри send_screen
+    await send_screen(
+        bot, user, key="main",
+        title_key="main_title", text_key="main_desc",
+        markup=kb_main(user_lang(user), user.is_platinum, can_open), session=session, message=c.message
+    )
     await c.answer()
 
 
 @router.callback_query(F.data == 'get_signal')
-async def cb_get_signal(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        if await has_access_now(user):
-            await send_screen(
-                bot, user, key='access',
-                title_key='access_title', text_key='access_text',
-                markup=kb_access(user_lang(user), vip=user.is_platinum)
-            )
-        else:
-            await evaluate_and_route(bot, user)
+async def cb_get_signal(c: CallbackQuery, bot: Bot, session: AsyncSession, user: User):
+    if await has_access_now(user):
+        await send_screen(
+            bot, user, key='access',
+            title_key='access_title', text_key='access_text',
+            markup=kb_access(user_lang(user), vip=user.is_platinum), session=session, message=c.message
+        )
+    else:
+        await evaluate_and_route(bot, user, session=session, message=c.message)
     await c.answer()
 
 
 
 # «Я подписался» на шаге подписки
 @router.callback_query(F.data == "check_sub")
-async def on_check_subscription(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-
-        is_sub = await check_subscription(bot, user.telegram_id)
-        if is_sub and not user.is_subscribed:
-            user.is_subscribed = True
-            await session.commit()
-
-        # просто двигаем дальше по воронке (и покажем алерт в evaluate, если нужно)
-        await evaluate_and_route(bot, user)
+async def on_check_subscription(c: CallbackQuery, bot: Bot, session: AsyncSession, user: User):
+    # пользователь только что подписался — спрашиваем Telegram мимо кэша
+    if not user.is_subscribed and await check_subscription(bot, user.telegram_id, fresh=True):
+        user.is_subscribed = True
+        await session.commit()
+    await evaluate_and_route(bot, user, session=session, message=c.message)
     await c.answer()
 
 
 # Кнопка регистрации из инструкции (callback)
 @router.callback_query(F.data == "btn_register")
-async def on_btn_register(c: CallbackQuery, bot: Bot):
-    async with get_session() as session:
-        user = await get_or_create_user(session, c.from_user.id)
-        lang = user_lang(user)
-
-        if user.is_registered:
-            await c.answer(t(lang, "already_registered"), show_alert=True)
-            return
-
-        user = await ensure_click_id(session, user)
-        reg_url = f"{settings.PUBLIC_BASE.rstrip('/')}/r/{user.click_id}/{await make_sig('reg', user.click_id)}"
-        await send_screen(
-            bot, user, key="register",
-            title_key="register_title", text_key="register_text",
-            markup=kb_register(lang, reg_url)
-        )
+async def on_btn_register(c: CallbackQuery, bot: Bot, session: AsyncSession, user: User):
+    lang = user_lang(user)
+
+    if user.is_registered:
+        await c.answer(t(lang, "already_registered"), show_alert=True)
+        return
+
+    user = await ensure_click_id(session, user)
+    reg_url = await short_link('reg', user.click_id)
+    await send_screen(
+        bot, user, key="register",
+        title_key="register_title", text_key="register_text",
+        markup=kb_register(lang, reg_url), session=session, message=c.message
+    )
     await c.answer()
 
 
 @router.message(Command("whoami"))
-async def cmd_whoami(m: Message):
-    async with get_session() as session:
-        res = await session.execute(select(User).where(User.telegram_id == m.from_user.id))
-        u = res.scalar_one_or_none()
-        if not u:
-            await m.answer("no user in db yet")
-            return
-        await m.answer(
-            "tg_id: {}\n"
-            "group: {}\n"
-            "lang: {}\n"
-            "subscribed: {}\n"
-            "registered: {}\n"
-            "has_deposit: {}\n"
-            "total_deposits: {}\n"
-            "platinum: {}\n"
-            "click_id: {}\n"
-            "trader_id: {}".format(
-                u.telegram_id, u.group_ab, u.language,
-                u.is_subscribed, u.is_registered, u.has_deposit,
-                u.total_deposits, u.is_platinum, u.click_id, u.trader_id
-            )
+async def cmd_whoami(m: Message, session: AsyncSession):
+    res = await session.execute(select(User).where(User.telegram_id == m.from_user.id))
+    u = res.scalar_one_or_none()
+    if not u:
+        await m.answer("no user in db yet")
+        return
+    await m.answer(
+        "tg_id: {}\n"
+        "group: {}\n"
+        "lang: {}\n"
+        "subscribed: {}\n"
+        "registered: {}\n"
+        "has_deposit: {}\n"
+        "total_deposits: {}\n"
+        "platinum: {}\n"
+        "click_id: {}\n"
+        "trader_id: {}".format(
+            u.telegram_id, u.group_ab, u.language,
+            u.is_subscribed, u.is_registered, u.has_deposit,
+            u.total_deposits, u.is_platinum, u.click_id, u.trader_id
         )
+    )
 
 
 # ----------------- entry -----------------
-async def main() -> None:
-    await init_db()
-    await load_button_overrides()
-    dp = Dispatcher()
+def create_bot() -> Bot:
+    session = None
+    if settings.BOT_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(settings.BOT_API_URL))
+    bot = Bot(token=settings.TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    # все исходящие идут через общий лимитер (sender.py); спан трассы — снаружи, с ожиданием
+    return install_sender(install_tracing(bot))
+
+
+def build_dispatcher() -> Dispatcher:
+    # состояние админских сценариев — в общем хранилище (см. fsm_storage.py)
+    dp = Dispatcher(storage=build_storage(persist=lambda key: is_admin(key.user_id)))
+    dp.update.outer_middleware(trace_updates)
+    dp.update.outer_middleware(QueryCounterMiddleware())
     dp.include_router(router)
     dp.include_router(admin_router)
-    bot = Bot(token=settings.TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+    return dp
+
+
+async def prepare(bot: Bot) -> None:
+    """Общий старт для polling и webhook: схема БД, прогрев кэшей, фоновые задачи."""
+    await init_db()
+    await ensure_stats()
+    await load_config()  # вместе с ним — кнопки и тексты экранов (on_config_reload)
+    await load_media_cache()
+    if settings.BACKGROUND_TASKS:
+        await resume_broadcasts(bot)
+        start_sweeper(bot)
+
+
+async def main() -> None:
+    if settings.BOT_MODE == "webhook":
+        # апдейты принимает postback_app (тот же процесс, тот же Bot и пул БД)
+        import uvicorn
+        print("Bot started (webhook) …")
+        await uvicorn.Server(uvicorn.Config(
+            "postback_app:app", host=settings.HTTP_HOST, port=settings.HTTP_PORT
+        )).serve()
+        return
+
+    if settings.BOT_WORKERS > 1:
+        # getUpdates в одном процессе, обработка — в BOT_WORKERS процессах
+        from workers import run_sharded
+        print(f"Bot started (polling, {settings.BOT_WORKERS} workers) …")
+        await run_sharded(settings.BOT_WORKERS)
+        return
+
+    dp = build_dispatcher()
+    bot = create_bot()
+    await prepare(bot)
+    if settings.METRICS_PORT:
+        await start_metrics_server(settings.HTTP_HOST, settings.METRICS_PORT, settings.METRICS_TOKEN)
+    # getUpdates не работает, пока висит вебхук от webhook-режима
+    await bot.delete_webhook(drop_pending_updates=False)
     print("Bot started …")
     await dp.start_polling(bot)
 
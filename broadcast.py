@@ -0,0 +1,216 @@
+from __future__ import annotations
+
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from sqlalchemy import select, func, update
+
+from admin_keyboards import kb_bcast_progress
+from db import get_session, User, BroadcastJob, BroadcastDelivery
+from metrics import Counter, Gauge
+from tracing import detach
+from ratelimit import TokenBucket
+from writequeue import run_write
+from settings import settings
+
+# потолок для рассылок процесса; общий лимит бота и лимиты на чат держит sender.py
+_bcast_bucket = TokenBucket(settings.BCAST_RATE)
+
+# job_id -> фоновая задача
+_RUNNING: Dict[int, asyncio.Task] = {}
+
+PROGRESS_EVERY = 3.0  # сек между правками статус-сообщения
+FLOOD_RETRIES = 3     # столько раз получателя откладываем после 429, потом пишем ошибку
+
+STATUS_LABELS = {"running": "⏳ идёт", "done": "✅ завершена", "stopped": "⏹ остановлена"}
+
+BCAST_MESSAGES = Counter("pocketai_broadcast_messages_total", "Broadcast deliveries by result", ["result"])
+Gauge("pocketai_broadcasts_running", "Broadcasts running in this process", fn=lambda: len(_RUNNING))
+
+
+def _segment_query(q, segment: str):
+    q = q.where(User.group_ab == 'A')  # B исключаем
+    if segment == "reg":
+        q = q.where(User.is_registered.is_(True))
+    elif segment == "dep":
+        q = q.where(User.has_deposit.is_(True))
+    elif segment == "start":
+        q = q.where(User.is_registered.is_(False), User.has_deposit.is_(False))
+    return q
+
+
+def progress_text(job: BroadcastJob) -> str:
+    return (
+        f"📣 Рассылка #{job.id} — {STATUS_LABELS.get(job.status, job.status)}\n"
+        f"Сегмент: {job.segment}\n"
+        f"Отправлено: {job.sent} / {job.total}\n"
+        f"Ошибок: {job.failed}"
+    )
+
+
+# ========= отправка =========
+
+async def _send_one(bot: Bot, job: BroadcastJob, tg_id: int) -> Optional[str]:
+    """None — доставлено, иначе короткое описание ошибки."""
+    await _bcast_bucket.acquire()
+    try:
+        if job.photo:
+            await bot.send_photo(tg_id, photo=job.photo, caption=job.text or None)
+        else:
+            await bot.send_message(tg_id, job.text or "(пусто)")
+        return None
+    except TelegramRetryAfter as e:
+        # sender уже выждал и повторил; раз не вышло — притормаживаем всю рассылку
+        _bcast_bucket.pause(e.retry_after)
+        return "retry_after"
+    except TelegramForbiddenError:
+        return "forbidden"
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"[:256]
+
+
+async def _report(bot: Bot, job_id: int) -> None:
+    async with get_session() as s:
+        job = await s.get(BroadcastJob, job_id)
+    if not job or not job.status_message_id:
+        return
+    try:
+        await bot.edit_message_text(
+            progress_text(job), chat_id=job.status_chat_id, message_id=job.status_message_id,
+            reply_markup=kb_bcast_progress(job.id, job.status == "running"),
+        )
+    except (TelegramBadRequest, TelegramRetryAfter):
+        pass  # "message is not modified" / флуд на правках — не критично
+
+
+async def _report_loop(bot: Bot, job_id: int) -> None:
+    while True:
+        await asyncio.sleep(PROGRESS_EVERY)
+        await _report(bot, job_id)
+
+
+async def _record(job_id: int, user_id: int, err: Optional[str]) -> None:
+    """Доставка и счётчики рассылки — сразу после отправки, до сдвига курсора."""
+    async def job(s) -> None:
+        s.add(BroadcastDelivery(job_id=job_id, user_id=user_id, ok=err is None, error=err))
+        await s.execute(
+            update(BroadcastJob).where(BroadcastJob.id == job_id).values(
+                sent=BroadcastJob.sent + (1 if err is None else 0),
+                failed=BroadcastJob.failed + (0 if err is None else 1),
+            )
+        )
+    # через очередь записей: на SQLite доставки параллельных отправок коммитятся пачкой
+    await run_write(job)
+
+
+async def _run(bot: Bot, job_id: int) -> None:
+    detach()  # рассылку запускает апдейт админа, но она живёт дольше его трассы
+    reporter = asyncio.create_task(_report_loop(bot, job_id))
+    flood_retries: Dict[int, int] = defaultdict(int)  # user_id -> сколько раз упёрлись во флуд
+    try:
+        while True:
+            async with get_session() as s:
+                job = await s.get(BroadcastJob, job_id)
+                if not job or job.status != "running":
+                    return
+
+                # следующая пачка по keyset-курсору, без OFFSET и без загрузки всех юзеров
+                q = _segment_query(select(User.id, User.telegram_id), job.segment)
+                q = q.where(User.id > job.last_user_id).order_by(User.id).limit(settings.BCAST_CHUNK)
+                rows = (await s.execute(q)).all()
+                if not rows:
+                    job.status = "done"
+                    job.finished_at = datetime.utcnow()
+                    await s.commit()
+                    return
+
+                # при возобновлении пропускаем тех, кому уже отправили: доставка пишется сразу
+                # после отправки, так что повторно получат только те, чья запись не успела
+                # закоммититься до падения (не больше BCAST_CONCURRENCY человек)
+                done = set((await s.execute(
+                    select(BroadcastDelivery.user_id).where(
+                        BroadcastDelivery.job_id == job_id,
+                        BroadcastDelivery.user_id.in_([r.id for r in rows]),
+                    )
+                )).scalars())
+
+            sem = asyncio.Semaphore(settings.BCAST_CONCURRENCY)
+
+            async def one(user_id: int, tg_id: int) -> bool:
+                async with sem:
+                    err = await _send_one(bot, job, tg_id)
+                    label = "ok" if err is None else (err if err in ("forbidden", "retry_after") else "error")
+                    BCAST_MESSAGES.inc(result=label)
+                    if err == "retry_after" and flood_retries[user_id] < FLOOD_RETRIES:
+                        # не записываем: получатель остаётся в очереди и попадёт в следующий проход
+                        flood_retries[user_id] += 1
+                        return False
+                    await _record(job_id, user_id, err)
+                    return True
+
+            todo = [r for r in rows if r.id not in done]
+            recorded = await asyncio.gather(*(one(r.id, r.telegram_id) for r in todo))
+            postponed = [r.id for r, ok in zip(todo, recorded) if not ok]
+
+            # курсор двигаем, только когда всё до него записано в broadcast_deliveries;
+            # отложенные после флуда — до первого из них, уже доставленных отсеет done
+            cursor = min(postponed) - 1 if postponed else rows[-1].id
+            async with get_session() as s:
+                await s.execute(
+                    update(BroadcastJob).where(BroadcastJob.id == job_id).values(last_user_id=cursor)
+                )
+                await s.commit()
+    finally:
+        reporter.cancel()
+        _RUNNING.pop(job_id, None)
+        await _report(bot, job_id)
+
+
+def _start(bot: Bot, job_id: int) -> None:
+    if job_id not in _RUNNING:
+        _RUNNING[job_id] = asyncio.create_task(_run(bot, job_id))
+
+
+# ========= API для админки / старта =========
+
+async def launch_broadcast(bot: Bot, admin_id: int, chat_id: int,
+                           segment: str, text: str, photo: str) -> BroadcastJob:
+    """Создаёт задание, присылает статус-сообщение и запускает рассылку в фоне."""
+    async with get_session() as s:
+        total = await s.scalar(_segment_query(select(func.count(User.id)), segment))
+        job = BroadcastJob(admin_id=admin_id, segment=segment, text=text, photo=photo,
+                           total=total or 0, status_chat_id=chat_id)
+        s.add(job)
+        await s.commit()
+
+        msg = await bot.send_message(chat_id, progress_text(job), reply_markup=kb_bcast_progress(job.id, True))
+        job.status_message_id = msg.message_id
+        await s.commit()
+
+    _start(bot, job.id)
+    return job
+
+
+async def stop_broadcast(job_id: int) -> None:
+    """Останавливает рассылку после текущей пачки."""
+    async with get_session() as s:
+        await s.execute(
+            update(BroadcastJob)
+            .where(BroadcastJob.id == job_id, BroadcastJob.status == "running")
+            .values(status="stopped", finished_at=datetime.utcnow())
+        )
+        await s.commit()
+
+
+async def resume_broadcasts(bot: Bot) -> None:
+    """Поднимает незавершённые рассылки после рестарта процесса."""
+    async with get_session() as s:
+        ids = (await s.execute(
+            select(BroadcastJob.id).where(BroadcastJob.status == "running")
+        )).scalars().all()
+    for job_id in ids:
+        _start(bot, job_id)
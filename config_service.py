@@ -1,39 +1,137 @@
 from __future__ import annotations
 
-from typing import Optional,Dict, Tuple
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Dict, List, Tuple
+from uuid import uuid4
+
 from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from db import get_session, Config, BtnOverride
+from db import get_session, Config, BtnOverride, ContentOverride
+from metrics import cache_hit, cache_miss
+from tracing import span
 from settings import settings
+from texts import t, LANGS, SCREEN_MAP
 
 # in-memory кэш: {(lang, key): text}
 BTN_CACHE: Dict[Tuple[str, str], str] = {}
 
+# in-memory кэш всей таблицы Config: {key: value}
+CONFIG_CACHE: Dict[str, str] = {}
+
+# Ключ в Config со случайным токеном версии. Любая запись через set_value меняет токен,
+# а другие процессы (postback_app) раз в CONFIG_CACHE_TTL сверяют его одним PK-запросом
+# и перечитывают таблицу, если он изменился.
+VERSION_KEY = "CACHE_VERSION"
+
+_cache_state = {"loaded": False, "version": None, "checked_at": 0.0}
+_cache_lock = asyncio.Lock()
+
+# подписчики на смену конфига (другие кэши, которые строятся из Config)
+_RELOAD_HOOKS: List[Callable[[], Awaitable[None]]] = []
+
+# кому сообщить о записи в конфиг из этого процесса (межпроцессный канал, см. workers.py)
+_CHANGE_LISTENERS: List[Callable[[], None]] = []
+
+
+# ========= кэш конфига =========
+
+def on_config_reload(hook: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+    """Регистрирует async-коллбэк, который вызывается после каждой перезагрузки кэша."""
+    _RELOAD_HOOKS.append(hook)
+    return hook
+
+
+async def _read_version() -> Optional[str]:
+    async with get_session() as session:
+        return await session.scalar(select(Config.value).where(Config.key == VERSION_KEY))
+
+
+async def load_config() -> None:
+    """Загружает всю таблицу Config в память одним запросом и оповещает подписчиков."""
+    async with get_session() as session:
+        res = await session.execute(select(Config))
+        rows = {row.key: row.value for row in res.scalars()}
+    CONFIG_CACHE.clear()
+    CONFIG_CACHE.update(rows)
+    _cache_state.update(loaded=True, version=rows.get(VERSION_KEY), checked_at=time.monotonic())
+    for hook in _RELOAD_HOOKS:
+        await hook()
+
+
+def on_config_change(listener: Callable[[], None]) -> None:
+    """Регистрирует sync-коллбэк на локальные записи в конфиг (set_value и т.п.)."""
+    _CHANGE_LISTENERS.append(listener)
+
+
+def invalidate_config(broadcast: bool = True) -> None:
+    """
+    Помечает кэш устаревшим: следующее чтение перечитает таблицу целиком.
+    broadcast=False — сигнал пришёл от соседнего процесса, дальше не рассылаем.
+    """
+    _cache_state["loaded"] = False
+    if broadcast:
+        for listener in _CHANGE_LISTENERS:
+            listener()
+
+
+async def ensure_config_fresh() -> None:
+    """
+    Дёшево, если кэш свежий (без обращения к БД).
+    После истечения TTL сверяет токен версии; при расхождении — полная перезагрузка.
+    """
+    if _cache_state["loaded"] and time.monotonic() - _cache_state["checked_at"] < settings.CONFIG_CACHE_TTL:
+        cache_hit("config")
+        return
+    cache_miss("config")
+    with span("config.refresh"):
+        async with _cache_lock:
+            if not _cache_state["loaded"]:
+                await load_config()
+                return
+            if time.monotonic() - _cache_state["checked_at"] < settings.CONFIG_CACHE_TTL:
+                return  # пока ждали лок, кэш уже обновил другой корутин
+            version = await _read_version()
+            if version != _cache_state["version"]:
+                await load_config()
+            else:
+                _cache_state["checked_at"] = time.monotonic()
+
+
 # ========= базовые helpers =========
 
 async def get_value(key: str, default: Optional[str] = None) -> Optional[str]:
     """
-    Читает значение из таблицы Config. Если ключа нет — возвращает default.
+    Читает значение из кэша таблицы Config. Если ключа нет — возвращает default.
     """
-    async with get_session() as session:
-        res = await session.execute(select(Config).where(Config.key == key))
-        row = res.scalar_one_or_none()
-        return row.value if row else default
+    await ensure_config_fresh()
+    return CONFIG_CACHE.get(key, default)
+
+
+async def _put(session: AsyncSession, key: str, value: str) -> None:
+    row = await session.get(Config, key)
+    if row:
+        row.value = value
+    else:
+        session.add(Config(key=key, value=value))
+
+
+async def bump_version(session: AsyncSession) -> None:
+    """Меняет токен версии в транзакции вызывающего: другие процессы перечитают кэши."""
+    await _put(session, VERSION_KEY, uuid4().hex)
 
 
 async def set_value(key: str, value: str) -> None:
     """
-    Пишет/обновляет значение в таблице Config.
+    Пишет/обновляет значение в таблице Config и меняет токен версии в той же транзакции.
     """
     async with get_session() as session:
-        res = await session.execute(select(Config).where(Config.key == key))
-        row = res.scalar_one_or_none()
-        if row:
-            row.value = value
-        else:
-            row = Config(key=key, value=value)
-            session.add(row)
+        await _put(session, key, value)
+        await bump_version(session)
         await session.commit()
+    invalidate_config()
 
 
 async def get_bool(key: str, default: bool) -> bool:
@@ -139,7 +237,9 @@ async def set_bcast_photo(v: str) -> None:
     await set_value("BCAST_PHOTO", v)
 
 
+@on_config_reload
 async def load_button_overrides() -> None:
+    """Перечитывается вместе с кэшем конфига — правки кнопок видят все процессы."""
     async with get_session() as s:
         res = await s.execute(select(BtnOverride))
         BTN_CACHE.clear()
@@ -160,13 +260,107 @@ async def set_btn_text(lang: str, key: str, value: str) -> None:
             row.text = value
         else:
             s.add(BtnOverride(lang=lang, key=key, text=value))
+        await bump_version(s)
         await s.commit()
     BTN_CACHE[(lang, key)] = value
+    invalidate_config()
 
 async def del_btn_text(lang: str, key: str) -> None:
     async with get_session() as s:
         await s.execute(delete(BtnOverride).where(
             BtnOverride.lang == lang, BtnOverride.key == key
         ))
+        await bump_version(s)
+        await s.commit()
+    BTN_CACHE.pop((lang, key), None)
+    invalidate_config()
+
+
+# ========= контент экранов (ContentOverride) =========
+
+@dataclass(frozen=True)
+class ScreenContent:
+    title: str
+    body: str
+    caption: str      # готовая подпись "<b>title</b>\n\nbody"
+    fits_photo: bool  # влезает ли подпись в caption фото (1024 символа)
+
+
+# сырые оверрайды из админки: {(lang, screen): (title, text)}
+CONTENT_OVERRIDES: Dict[Tuple[str, str], Tuple[Optional[str], Optional[str]]] = {}
+
+# готовые экраны: {(lang, screen): ScreenContent} для всех LANGS × SCREEN_MAP
+CONTENT_CACHE: Dict[Tuple[str, str], ScreenContent] = {}
+
+
+def _resolve(lang: str, screen: str, title_key: str, text_key: str) -> ScreenContent:
+    title, body = t(lang, title_key), t(lang, text_key)
+    ov = CONTENT_OVERRIDES.get((lang, screen))
+    if ov:
+        title = ov[0] or title
+        body = ov[1] or body
+    caption = f"<b>{title}</b>\n\n{body}"
+    return ScreenContent(title, body, caption, len(caption) <= 1024)
+
+
+def _rebuild_content() -> None:
+    CONTENT_CACHE.clear()
+    for lang in LANGS:
+        for screen, (title_key, text_key) in SCREEN_MAP.items():
+            CONTENT_CACHE[(lang, screen)] = _resolve(lang, screen, title_key, text_key)
+
+
+@on_config_reload
+async def load_content_overrides() -> None:
+    """Перечитывается вместе с кэшем конфига (на старте и при смене токена версии)."""
+    async with get_session() as s:
+        res = await s.execute(select(ContentOverride))
+        CONTENT_OVERRIDES.clear()
+        for row in res.scalars():
+            CONTENT_OVERRIDES[(row.lang, row.screen)] = (row.title, row.text)
+    _rebuild_content()
+
+
+async def screen_content(lang: str, screen: str, title_key: str, text_key: str) -> ScreenContent:
+    """Тексты экрана без обращения к БД (кроме редкой сверки версии по TTL)."""
+    await ensure_config_fresh()
+    if SCREEN_MAP.get(screen) == (title_key, text_key):
+        cached = CONTENT_CACHE.get((lang, screen))
+        if cached:
+            return cached
+    return _resolve(lang, screen, title_key, text_key)
+
+
+def content_override(lang: str, screen: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+    return CONTENT_OVERRIDES.get((lang, screen))
+
+
+async def set_content_text(lang: str, screen: str, text: str) -> None:
+    """Сохраняет текст экрана и токен версии одной транзакцией, затем обновляет кэш."""
+    async with get_session() as s:
+        res = await s.execute(select(ContentOverride).where(
+            ContentOverride.lang == lang, ContentOverride.screen == screen
+        ))
+        ov = res.scalar_one_or_none()
+        if not ov:
+            ov = ContentOverride(lang=lang, screen=screen, text=text)
+            s.add(ov)
+        else:
+            ov.text = text
+        await bump_version(s)
+        await s.commit()
+        CONTENT_OVERRIDES[(lang, screen)] = (ov.title, ov.text)
+    _rebuild_content()
+    invalidate_config()
+
+
+async def reset_content(lang: str, screen: str) -> None:
+    async with get_session() as s:
+        await s.execute(delete(ContentOverride).where(
+            ContentOverride.lang == lang, ContentOverride.screen == screen
+        ))
+        await bump_version(s)
         await s.commit()
-    BTN_CACHE.pop((lang, key), None)
\ No newline at end of file
+    CONTENT_OVERRIDES.pop((lang, screen), None)
+    _rebuild_content()
+    invalidate_config()
@@ -1,18 +1,70 @@
-from datetime import datetime
-from typing import Optional
+import hashlib
+from contextvars import ContextVar
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
 from sqlalchemy import (
-    BigInteger, Integer, String, Boolean, Float, Text,  # <-- добавил Text
-    select, func, UniqueConstraint
+    BigInteger, Integer, String, Boolean, Float, Text, Date,  # <-- добавил Text
+    select, update, func, UniqueConstraint, Index, event, make_url
 )
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 from settings import settings
 
-engine = create_async_engine(settings.DATABASE_URL, echo=False, pool_pre_ping=True)
+def engine_kwargs(url: str) -> dict:
+    """Параметры движка под диалект: пул и таймауты для PostgreSQL (asyncpg)."""
+    kwargs = dict(echo=False, pool_pre_ping=True)
+    if make_url(url).get_backend_name() == "postgresql":
+        connect_args = {
+            "server_settings": {
+                "statement_timeout": str(settings.DB_STATEMENT_TIMEOUT_MS),
+                "application_name": "pocketai",
+            },
+            # кэш подготовленных выражений SQLAlchemy-адаптера; 0 — для pgbouncer в transaction-режиме
+            "prepared_statement_cache_size": settings.PG_STATEMENT_CACHE_SIZE,
+        }
+        if settings.PG_STATEMENT_CACHE_SIZE == 0:
+            connect_args["statement_cache_size"] = 0  # и собственный кэш asyncpg
+        kwargs.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+            connect_args=connect_args,
+        )
+    return kwargs
+
+
+engine = create_async_engine(settings.DATABASE_URL, **engine_kwargs(settings.DATABASE_URL))
 AsyncSessionLocal = async_sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+# счётчик SQL-запросов текущего апдейта/запроса (см. middlewares.QueryCounterMiddleware)
+query_counter: ContextVar[Optional[List[int]]] = ContextVar("query_counter", default=None)
+
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL: читатели не блокируют писателя; NORMAL — fsync на checkpoint, а не на каждый commit
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT_MS)}")
+        cur.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        cur.execute(f"PRAGMA cache_size=-{int(settings.SQLITE_CACHE_SIZE_KB)}")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.close()
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+
 class Base(DeclarativeBase):
     pass
 
@@ -33,7 +85,10 @@ class User(Base):
     is_registered: Mapped[bool] = mapped_column(Boolean, default=False)
     has_deposit: Mapped[bool] = mapped_column(Boolean, default=False)
 
-    total_deposits: Mapped[float] = mapped_column(Float, default=0.0)
+    # сумма депозитов в центах; прежняя float-колонка total_deposits остаётся зеркалом
+    # (пишется тем же UPDATE) — чтобы старые выгрузки и откат версии видели актуальную сумму
+    total_deposits_cents: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    _total_deposits_legacy: Mapped[float] = mapped_column("total_deposits", Float, default=0.0)
     is_platinum: Mapped[bool] = mapped_column(Boolean, default=False)
 
     access_notified: Mapped[bool] = mapped_column(Boolean, default=False)
@@ -43,6 +98,22 @@ class User(Base):
 
     created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
 
+    @hybrid_property
+    def total_deposits(self) -> float:
+        return (self.total_deposits_cents or 0) / 100
+
+    @total_deposits.inplace.expression
+    @classmethod
+    def _total_deposits_expr(cls):
+        return cls.total_deposits_cents / 100.0
+
+    __table_args__ = (
+        # keyset-пагинация админки и выборки рассылок: WHERE group_ab [AND флаг] ORDER BY id
+        Index("ix_users_group_id", "group_ab", "id"),
+        Index("ix_users_group_reg_id", "group_ab", "is_registered", "id"),
+        Index("ix_users_group_dep_id", "group_ab", "has_deposit", "id"),
+    )
+
 
 class Config(Base):
     __tablename__ = "config"
@@ -74,15 +145,167 @@ class BtnOverride(Base):
     )
 
 
+class MediaFileId(Base):
+    """file_id картинок экранов, уже загруженных в Telegram (чтобы не слать байты повторно)."""
+    __tablename__ = "media_file_ids"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    lang: Mapped[str] = mapped_column(String(5))
+    screen: Mapped[str] = mapped_column(String(32))
+    fingerprint: Mapped[str] = mapped_column(String(128))  # путь + mtime + размер файла
+    file_id: Mapped[str] = mapped_column(String(256))
+
+    __table_args__ = (
+        UniqueConstraint("lang", "screen", name="uix_media_lang_screen"),
+    )
+
+
+class BroadcastJob(Base):
+    """Фоновая рассылка: снимок текста/фото, курсор по users.id и счётчики прогресса."""
+    __tablename__ = "broadcast_jobs"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    admin_id: Mapped[int] = mapped_column(BigInteger)
+    segment: Mapped[str] = mapped_column(String(16), default="all")
+    text: Mapped[str] = mapped_column(Text, default="")
+    photo: Mapped[str] = mapped_column(String(256), default="")
+
+    status: Mapped[str] = mapped_column(String(16), default="running", index=True)  # running / done / stopped
+    last_user_id: Mapped[int] = mapped_column(Integer, default=0)  # keyset-курсор: всё, что <= уже обработано
+    total: Mapped[int] = mapped_column(Integer, default=0)
+    sent: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+
+    # сообщение со статусом, которое редактируем по ходу рассылки
+    status_chat_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    status_message_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+
+
+class BroadcastDelivery(Base):
+    """Результат отправки конкретному получателю (чтобы при возобновлении не слать повторно)."""
+    __tablename__ = "broadcast_deliveries"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    job_id: Mapped[int] = mapped_column(Integer, index=True)
+    user_id: Mapped[int] = mapped_column(Integer)
+    ok: Mapped[bool] = mapped_column(Boolean, default=False)
+    error: Mapped[Optional[str]] = mapped_column(String(256), nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("job_id", "user_id", name="uix_bcast_job_user"),
+    )
+
+
+class PostbackEvent(Base):
+    """Журнал принятых постбэков: повтор того же события возвращает сохранённый ответ."""
+    __tablename__ = "postback_events"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    dedup_key: Mapped[str] = mapped_column(String(64), unique=True)  # sha256 от полей события
+    event: Mapped[str] = mapped_column(String(32))
+    click_id: Mapped[str] = mapped_column(String(64), index=True)
+    trader_id: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    # сумма в центах — сходится с users.total_deposits_cents без погрешностей float;
+    # прежняя float-колонка amount пишется рядом зеркалом (старые выгрузки, откат версии)
+    amount_cents: Mapped[int] = mapped_column(BigInteger, default=0, server_default="0")
+    _amount_legacy: Mapped[float] = mapped_column("amount", Float, default=0.0)
+    tx_id: Mapped[Optional[str]] = mapped_column(String(128), nullable=True)
+    response: Mapped[str] = mapped_column(Text)  # JSON ответа партнёрке
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+
+class OutboxJob(Base):
+    """Отложенная работа с Telegram (пуши после постбэков), которую разбирает воркер."""
+    __tablename__ = "outbox"
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[str] = mapped_column(String(32))
+    user_id: Mapped[int] = mapped_column(Integer)
+    payload: Mapped[str] = mapped_column(Text, default="{}")  # JSON
+
+    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending / done / failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    # когда можно брать в работу; при захвате сдвигается вперёд (аренда на время обработки)
+    next_attempt_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    last_error: Mapped[Optional[str]] = mapped_column(String(256), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_outbox_status_due", "status", "next_attempt_at"),
+    )
+
+
+class StatsDaily(Base):
+    """
+    Свёртка воронки по дню прихода юзера × группе × языку.
+    Поддерживается инкрементально (stats.py), так что экран статистики не сканирует users.
+    """
+    __tablename__ = "stats_daily"
+
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    group_ab: Mapped[str] = mapped_column(String(1), primary_key=True)
+    lang: Mapped[str] = mapped_column(String(2), primary_key=True)  # '' — язык ещё не выбран
+
+    users: Mapped[int] = mapped_column(Integer, default=0)
+    subscribed: Mapped[int] = mapped_column(Integer, default=0)
+    registered: Mapped[int] = mapped_column(Integer, default=0)
+    deposited: Mapped[int] = mapped_column(Integer, default=0)
+    platinum: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class Counter(Base):
+    """Именованные атомарные счётчики (например, для раскладки A/B)."""
+    __tablename__ = "counters"
+
+    name: Mapped[str] = mapped_column(String(32), primary_key=True)
+    value: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+AB_COUNTER = "ab_signup"
+
+
+class FsmState(Base):
+    """FSM aiogram (fsm_storage.SqlStorage): общий для процессов и переживает рестарт."""
+    __tablename__ = "fsm_states"
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)  # bot:chat:user:destiny
+    state: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    data: Mapped[Optional[str]] = mapped_column(Text, nullable=True)       # JSON
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, index=True)
+
+
+class SchemaVersion(Base):
+    """Применённые миграции схемы (см. migrations.py)."""
+    __tablename__ = "schema_version"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+    name: Mapped[str] = mapped_column(String(128))
+    applied_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+
+
 async def init_db() -> None:
+    from migrations import migrate
+    check_ab_strategy()  # опечатка в .env не должна молча переключать стратегию
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate)
 
 
 def get_session() -> AsyncSession:
     return AsyncSessionLocal()
 
 
+def dialect_insert(table):
+    """INSERT с поддержкой ON CONFLICT для текущего диалекта (SQLite / PostgreSQL)."""
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(table)
+
+
 def gen_click_id() -> str:
     from uuid import uuid4
     return uuid4().hex
@@ -92,27 +315,107 @@ async def ensure_click_id(session: AsyncSession, user: "User") -> "User":
     if not user.click_id:
         user.click_id = gen_click_id()
         await session.commit()
-        await session.refresh(user)
     return user
 
 
-async def get_user_by_click_id(session: AsyncSession, click_id: str) -> Optional["User"]:
-    result = await session.execute(select(User).where(User.click_id == click_id))
+async def get_user_by_click_id(session: AsyncSession, click_id: str,
+                               for_update: bool = False) -> Optional["User"]:
+    q = select(User).where(User.click_id == click_id)
+    if for_update:
+        q = q.with_for_update()  # PostgreSQL: блокируем строку до конца транзакции; SQLite игнорирует
+    result = await session.execute(q)
     return result.scalar_one_or_none()
 
 
+def to_cents(amount: float) -> int:
+    """Сумма из постбэка -> целые центы (через Decimal, без артефактов float)."""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+# ========= A/B-группы =========
+
+def _ab_weights() -> List[Tuple[str, int]]:
+    """AB_WEIGHTS вида 'A:2,B:1' → [('A', 2), ('B', 1)]; мусор игнорируем."""
+    out: List[Tuple[str, int]] = []
+    for part in settings.AB_WEIGHTS.replace(";", ",").split(","):
+        name, _, w = part.partition(":")
+        name, w = name.strip().upper(), w.strip()
+        if name and w.isdigit() and int(w) > 0:
+            out.append((name[:1], int(w)))
+    return out or [("A", 2), ("B", 1)]
+
+
+def _pick_group(index: int) -> str:
+    """index-й слот в раскладке весов: для A:2,B:1 это A, A, B, A, A, B, …"""
+    weights = _ab_weights()
+    slot = index % sum(w for _, w in weights)
+    for name, w in weights:
+        if slot < w:
+            return name
+        slot -= w
+    return weights[0][0]
+
+
+async def _ab_hash(session: AsyncSession, tg_id: int) -> str:
+    """Детерминированно по telegram_id: без записей в БД, доли — в среднем по весам."""
+    digest = hashlib.sha256(str(tg_id).encode()).digest()
+    return _pick_group(int.from_bytes(digest[:8], "big"))
+
+
+async def _ab_sequence(session: AsyncSession, tg_id: int) -> str:
+    """Строгое чередование по атомарному счётчику (UPDATE … RETURNING), без COUNT по users."""
+    stmt = (
+        update(Counter).where(Counter.name == AB_COUNTER)
+        .values(value=Counter.value + 1).returning(Counter.value)
+    )
+    value = (await session.execute(stmt)).scalar_one_or_none()
+    if value is None:
+        # первый запуск: продолжаем нумерацию с числа уже существующих юзеров (разовый COUNT)
+        total = await session.scalar(select(func.count(User.id)))
+        await session.execute(
+            dialect_insert(Counter).values(name=AB_COUNTER, value=total or 0)
+            .on_conflict_do_nothing(index_elements=[Counter.name])
+        )
+        value = (await session.execute(stmt)).scalar_one()
+    # value — порядковый номер нового юзера (с 1), как было в старой схеме через COUNT
+    return _pick_group(value - 1)
+
+
+AB_STRATEGIES: Dict[str, Callable[[AsyncSession, int], Awaitable[str]]] = {
+    "hash": _ab_hash,
+    "sequence": _ab_sequence,
+}
+
+
+def check_ab_strategy() -> None:
+    if settings.AB_STRATEGY not in AB_STRATEGIES:
+        raise ValueError(
+            f"unknown AB_STRATEGY={settings.AB_STRATEGY!r}, expected one of: {', '.join(AB_STRATEGIES)}"
+        )
+
+
+async def assign_group(session: AsyncSession, tg_id: int) -> str:
+    return await AB_STRATEGIES[settings.AB_STRATEGY](session, tg_id)
+
+
 async def get_or_create_user(session: AsyncSession, tg_id: int) -> "User":
     result = await session.execute(select(User).where(User.telegram_id == tg_id))
     user = result.scalar_one_or_none()
     if user:
         return user
 
-    total = await session.scalar(select(func.count(User.id)))
-    next_index = (total or 0) + 1
-    group = 'B' if (next_index % 3 == 0) else 'A'
+    group = await assign_group(session, tg_id)
 
-    user = User(telegram_id=tg_id, group_ab=group)
-    session.add(user)
+    # параллельный /start того же юзера не падает на unique, а просто ничего не вставляет
+    res = await session.execute(
+        dialect_insert(User).values(telegram_id=tg_id, group_ab=group)
+        .on_conflict_do_nothing(index_elements=[User.telegram_id])
+    )
+    if res.rowcount == 1:
+        # Core-INSERT мимо ORM — свёртку статистики двигаем сами
+        from stats import track_signup
+        await track_signup(session, group)
     await session.commit()
-    await session.refresh(user)
-    return user
+
+    result = await session.execute(select(User).where(User.telegram_id == tg_id))
+    return result.scalar_one()
@@ -0,0 +1,125 @@
+"""
+Хранилище FSM для Dispatcher (FSM_STORAGE):
+
+- sql (по умолчанию) — таблица fsm_states в той же БД: состояние админских сценариев
+  переживает рестарт и видно всем процессам бота. Строка живёт, пока есть state или data,
+  пустые удаляются сразу, брошенные — через FSM_STATE_TTL;
+- redis — aiogram RedisStorage (нужен пакет redis и REDIS_URL);
+- memory — как раньше, в памяти процесса.
+
+FSM сейчас используют только админ-сценарии. FSMContextMiddleware читает состояние на каждом
+апдейте, поэтому SqlStorage ходит в БД только для ключей, прошедших persist(key);
+остальные чаты обслуживает память процесса — обычный юзер не платит лишним запросом.
+"""
+from __future__ import annotations
+
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import select, update, delete
+
+from db import get_session, dialect_insert, FsmState
+from settings import settings
+
+PURGE_EVERY = 600.0  # сек между чистками просроченных строк
+
+
+class SqlStorage(BaseStorage):
+    def __init__(self, ttl: float, persist: Optional[Callable[[StorageKey], bool]] = None):
+        self.ttl = timedelta(seconds=ttl)
+        self.persist = persist or (lambda key: True)
+        self.fallback = MemoryStorage()
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._purged_at = 0.0
+
+    def _fresh(self):
+        return FsmState.updated_at >= datetime.utcnow() - self.ttl
+
+    async def _upsert(self, key: StorageKey, **values: Any) -> None:
+        values["updated_at"] = datetime.utcnow()
+        stmt = dialect_insert(FsmState).values(key=self.key_builder.build(key), **values)
+        stmt = stmt.on_conflict_do_update(index_elements=[FsmState.key], set_=values)
+        async with get_session() as s:
+            await s.execute(stmt)
+            await self._maybe_purge(s)
+            await s.commit()
+
+    async def _clear(self, key: StorageKey, field: str, other_empty) -> None:
+        k = self.key_builder.build(key)
+        async with get_session() as s:
+            await s.execute(
+                update(FsmState).where(FsmState.key == k)
+                .values({field: None, "updated_at": datetime.utcnow()})
+            )
+            # ни состояния, ни данных — строка больше не нужна
+            await s.execute(delete(FsmState).where(FsmState.key == k, other_empty))
+            await s.commit()
+
+    async def _maybe_purge(self, s) -> None:
+        if time.monotonic() - self._purged_at < PURGE_EVERY:
+            return
+        self._purged_at = time.monotonic()
+        await s.execute(delete(FsmState).where(FsmState.updated_at < datetime.utcnow() - self.ttl))
+
+    async def _row(self, key: StorageKey) -> Optional[FsmState]:
+        async with get_session() as s:
+            return await s.scalar(
+                select(FsmState).where(FsmState.key == self.key_builder.build(key), self._fresh())
+            )
+
+    # ---- BaseStorage ----
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        if not self.persist(key):
+            return await self.fallback.set_state(key, state)
+        value = state.state if isinstance(state, State) else state
+        if value is None:
+            await self._clear(key, "state", FsmState.data.is_(None))
+        else:
+            await self._upsert(key, state=value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        if not self.persist(key):
+            return await self.fallback.get_state(key)
+        row = await self._row(key)
+        return row.state if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not self.persist(key):
+            return await self.fallback.set_data(key, data)
+        if not data:
+            await self._clear(key, "data", FsmState.state.is_(None))
+        else:
+            await self._upsert(key, data=json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        if not self.persist(key):
+            return await self.fallback.get_data(key)
+        row = await self._row(key)
+        return json.loads(row.data) if row and row.data else {}
+
+    async def close(self) -> None:
+        await self.fallback.close()
+
+
+def build_storage(persist: Optional[Callable[[StorageKey], bool]] = None) -> BaseStorage:
+    kind = settings.FSM_STORAGE
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "redis":
+        try:
+            from aiogram.fsm.storage.redis import RedisStorage
+        except ImportError as e:
+            raise RuntimeError("FSM_STORAGE=redis requires the 'redis' package") from e
+        return RedisStorage.from_url(
+            settings.REDIS_URL,
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=int(settings.FSM_STATE_TTL),
+            data_ttl=int(settings.FSM_STATE_TTL),
+        )
+    return SqlStorage(settings.FSM_STATE_TTL, persist=persist)
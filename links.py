@@ -0,0 +1,127 @@
+"""
+Подписанные редирект-ссылки /r/... и /d/... без обращения к БД на горячем пути.
+
+- HMAC-ключ из PB_SECRET готовится один раз и пересобирается при смене конфига;
+- реф-ссылки партнёрки (A — из Config, B — из .env) разобраны заранее,
+  на запрос остаётся только подставить click_id;
+- click_id -> группа A/B держим в небольшом LRU: группа пользователя не меняется.
+"""
+from __future__ import annotations
+
+import hashlib
+import hmac
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse, quote_plus
+
+from sqlalchemy import select
+
+from db import get_session, User
+from metrics import cache_hit, cache_miss
+from settings import settings
+from config_service import CONFIG_CACHE, on_config_reload, ensure_config_fresh
+
+# префикс короткой ссылки по виду подписи
+SHORT_PREFIX = {"reg": "r", "dep": "d"}
+
+GROUP_CACHE_SIZE = 10_000
+
+
+@dataclass(frozen=True)
+class RefTemplate:
+    """Реф-ссылка, разрезанная вокруг параметра click_id."""
+    head: str      # scheme://host/path
+    before: str    # уже закодированные параметры до click_id
+    after: str     # ... и после него (если click_id был в шаблоне)
+    fragment: str
+
+    @classmethod
+    def parse(cls, url: str) -> Optional["RefTemplate"]:
+        if not url:
+            return None
+        parts = urlparse(url)
+        # как и раньше через dict(parse_qsl(...)): последний дубль ключа побеждает
+        q = dict(parse_qsl(parts.query, keep_blank_values=True))
+        keys = list(q)
+        idx = keys.index("click_id") if "click_id" in q else len(keys)
+        return cls(
+            head=urlunparse(parts._replace(query="", fragment="")),
+            before=urlencode([(k, q[k]) for k in keys[:idx]]),
+            after=urlencode([(k, q[k]) for k in keys[idx + 1:]]),
+            fragment=parts.fragment,
+        )
+
+    def render(self, click_id: str) -> str:
+        query = "&".join(p for p in (self.before, "click_id=" + quote_plus(click_id), self.after) if p)
+        url = f"{self.head}?{query}"
+        return f"{url}#{self.fragment}" if self.fragment else url
+
+
+_key: Dict[str, hmac.HMAC] = {}
+_templates: Dict[Tuple[str, str], Optional[RefTemplate]] = {}
+_groups: "OrderedDict[str, str]" = OrderedDict()
+
+
+def _rebuild() -> None:
+    secret = CONFIG_CACHE.get("PB_SECRET", settings.PB_SECRET)
+    _key["pb"] = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+    _templates.update({
+        ("reg", "A"): RefTemplate.parse(CONFIG_CACHE.get("REF_REG_A", settings.REF_REG_A)),
+        ("dep", "A"): RefTemplate.parse(CONFIG_CACHE.get("REF_DEP_A", settings.REF_DEP_A)),
+        ("reg", "B"): RefTemplate.parse(settings.REF_REG_B),
+        ("dep", "B"): RefTemplate.parse(settings.REF_DEP_B),
+    })
+
+
+@on_config_reload
+async def reload_links() -> None:
+    """Перестраивается вместе с кэшем конфига (смена PB_SECRET / REF_*_A в админке)."""
+    _rebuild()
+
+
+async def sign(kind: str, click_id: str) -> str:
+    await ensure_config_fresh()
+    h = _key["pb"].copy()
+    h.update(f"{kind}:{click_id}".encode())
+    return h.hexdigest()
+
+
+async def verify(kind: str, click_id: str, sig: str) -> bool:
+    try:
+        return hmac.compare_digest(await sign(kind, click_id), sig)
+    except Exception:
+        return False
+
+
+async def short_link(kind: str, click_id: str) -> str:
+    """Публичная подписанная ссылка, которую бот кладёт в кнопки."""
+    sig = await sign(kind, click_id)
+    return f"{settings.PUBLIC_BASE.rstrip('/')}/{SHORT_PREFIX[kind]}/{click_id}/{sig}"
+
+
+def ref_url(kind: str, group: str, click_id: str) -> Optional[str]:
+    """Итоговая ссылка партнёрки; None — ссылка не настроена."""
+    tpl = _templates.get((kind, "B" if group == "B" else "A"))
+    return tpl.render(click_id) if tpl else None
+
+
+async def group_for_click(click_id: str) -> Optional[str]:
+    """Группа A/B по click_id: из LRU, при промахе — один запрос по уникальному индексу."""
+    group = _groups.get(click_id)
+    if group is not None:
+        _groups.move_to_end(click_id)
+        cache_hit("click_group")
+        return group
+    cache_miss("click_group")
+    async with get_session() as session:
+        group = await session.scalar(select(User.group_ab).where(User.click_id == click_id))
+    if group is None:
+        return None  # отрицательные ответы не кэшируем: пользователь может появиться позже
+    _groups[click_id] = group
+    if len(_groups) > GROUP_CACHE_SIZE:
+        _groups.popitem(last=False)
+    return group
+
+
+_rebuild()
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+from aiogram.types import FSInputFile, Message
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import get_session, dialect_insert, MediaFileId
+from metrics import cache_hit, cache_miss
+
+# in-memory кэш: {(lang, screen): (fingerprint, file_id)}
+MEDIA_CACHE: Dict[Tuple[str, str], Tuple[str, str]] = {}
+_loaded = False
+
+
+def _key(path: Path) -> Tuple[str, str]:
+    # assets/<lang>/<screen>.jpg
+    return path.parent.name, path.stem
+
+
+def fingerprint(path: Path) -> str:
+    st = path.stat()
+    return f"{path.parent.parent.name}:{st.st_mtime_ns}:{st.st_size}"
+
+
+async def load_media_cache() -> None:
+    global _loaded
+    async with get_session() as s:
+        res = await s.execute(select(MediaFileId))
+        MEDIA_CACHE.clear()
+        for row in res.scalars():
+            MEDIA_CACHE[(row.lang, row.screen)] = (row.fingerprint, row.file_id)
+    _loaded = True
+
+
+async def photo_input(path: Path) -> Union[str, FSInputFile]:
+    """
+    Что передавать в send_photo: file_id, если эта версия файла уже загружена, иначе сам файл.
+    """
+    if not _loaded:
+        await load_media_cache()
+    cached = MEDIA_CACHE.get(_key(path))
+    try:
+        if cached and cached[0] == fingerprint(path):
+            cache_hit("media")
+            return cached[1]
+    except OSError:
+        pass
+    cache_miss("media")
+    return FSInputFile(path)
+
+
+async def _upsert(s: AsyncSession, lang: str, screen: str, fp: str, file_id: str) -> None:
+    # ON CONFLICT: первую загрузку одной картинки могут сохранить сразу несколько процессов
+    stmt = dialect_insert(MediaFileId).values(lang=lang, screen=screen, fingerprint=fp, file_id=file_id)
+    await s.execute(stmt.on_conflict_do_update(
+        index_elements=[MediaFileId.lang, MediaFileId.screen],
+        set_={"fingerprint": fp, "file_id": file_id},
+    ))
+
+
+async def remember_photo(path: Path, msg: Message, session: Optional[AsyncSession] = None) -> None:
+    """
+    Сохраняет file_id после первой загрузки файла.
+    Если передана сессия — пишем в неё (закоммитит вызывающий): второе пишущее соединение
+    при открытой транзакции апдейта в SQLite упрётся в блокировку.
+    """
+    if not msg.photo:
+        return
+    lang, screen = _key(path)
+    fp = fingerprint(path)
+    cached = MEDIA_CACHE.get((lang, screen))
+    if cached and cached[0] == fp:
+        return  # слали по file_id — Telegram может вернуть другой id на тот же файл, храним первый
+    file_id = msg.photo[-1].file_id
+    if session is not None:
+        await _upsert(session, lang, screen, fp, file_id)
+    else:
+        async with get_session() as s:
+            await _upsert(s, lang, screen, fp, file_id)
+            await s.commit()
+    MEDIA_CACHE[(lang, screen)] = (fp, file_id)
+
+
+async def forget_photo(lang: str, screen: str, session: Optional[AsyncSession] = None) -> None:
+    """Сбрасывает file_id (картинку заменили/удалили в админке или Telegram его не принял)."""
+    stmt = delete(MediaFileId).where(MediaFileId.lang == lang, MediaFileId.screen == screen)
+    if session is not None:
+        await session.execute(stmt)
+    else:
+        async with get_session() as s:
+            await s.execute(stmt)
+            await s.commit()
+    MEDIA_CACHE.pop((lang, screen), None)
+
+
+async def forget_path(path: Path, session: Optional[AsyncSession] = None) -> None:
+    await forget_photo(*_key(path), session=session)
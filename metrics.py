@@ -0,0 +1,213 @@
+"""
+Метрики процесса в текстовом формате Prometheus — без внешних зависимостей.
+
+Счётчики, гауги и гистограммы живут в памяти процесса (REGISTRY) и отдаются:
+- postback_app: GET /metrics — только с METRICS_TOKEN (приложение смотрит в интернет);
+- polling-бот: отдельный HTTP-порт METRICS_PORT (0 — выключено; воркер N в режиме
+  BOT_WORKERS слушает METRICS_PORT + N).
+
+Метрики объявляются рядом с кодом, который их пишет; здесь — реестр и общие для нескольких
+модулей метрики (шаги бота, попадания в кэши). Гауги/счётчики с fn читают значения
+при каждом scrape (например, SEND_STATS и QUERY_STATS).
+"""
+from __future__ import annotations
+
+import functools
+import hmac
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+LabelKey = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REGISTRY: List["_Metric"] = []
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 fn: Optional[Callable[[], object]] = None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.fn = fn
+        self._values: Dict[LabelKey, float] = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> Iterable[Tuple[LabelKey, float]]:
+        if self.fn is None:
+            return list(self._values.items())
+        got = self.fn()
+        if isinstance(got, dict):
+            return [((k,) if isinstance(k, str) else tuple(k), v) for k, v in got.items()]
+        return [((), got)]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._samples():
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {_num(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelKey, List[float]] = {}  # counts по бакетам + [sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0.0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def timed(self, **labels):
+        """Декоратор для корутин: длительность вызова с заданными метками."""
+        def deco(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return await fn(*args, **kwargs)
+            return wrapper
+        return deco
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, series in list(self._series.items()):
+            acc = 0.0
+            for bound, n in zip(self.buckets, series):
+                acc += n  # бакеты в формате Prometheus накопительные
+                le = f'le="{_num(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {_num(acc)}")
+            inf = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, inf)} {_num(series[-1])}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(series[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {_num(series[-1])}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+def authorized(token: str, header: str = "", query: str = "", open_without_token: bool = True) -> bool:
+    """
+    Bearer-заголовок или ?token=. Токен не задан — доступ открыт только там, где это явно
+    разрешено (отдельный METRICS_PORT); публичный postback_app без токена метрики не отдаёт.
+    """
+    if not token:
+        return open_without_token
+    given = header[7:] if header.startswith("Bearer ") else query
+    return hmac.compare_digest(given or "", token)
+
+
+# ========= общие метрики =========
+
+STEP_SECONDS = Histogram(
+    "pocketai_step_seconds", "Duration of bot hot-path steps", ["step"],
+)
+
+CACHE_REQUESTS = Counter(
+    "pocketai_cache_requests_total", "In-process cache lookups by result (hit/miss)", ["cache", "result"],
+)
+
+
+def cache_hit(cache: str) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="hit")
+
+
+def cache_miss(cache: str) -> None:
+    CACHE_REQUESTS.inc(cache=cache, result="miss")
+
+
+def _hit_ratios() -> Dict[str, float]:
+    totals: Dict[str, List[float]] = {}
+    for (cache, result), n in list(CACHE_REQUESTS._values.items()):
+        hits_total = totals.setdefault(cache, [0.0, 0.0])
+        hits_total[1] += n
+        if result == "hit":
+            hits_total[0] += n
+    return {cache: hits / total for cache, (hits, total) in totals.items() if total}
+
+
+Gauge("pocketai_cache_hit_ratio", "Share of cache lookups served from memory since start", ["cache"],
+      fn=_hit_ratios)
+
+
+# ========= HTTP для polling-бота =========
+
+async def start_metrics_server(host: str, port: int, token: str = ""):
+    """Отдельный aiohttp-сервер с /metrics (в webhook-режиме метрики отдаёт postback_app)."""
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        if not authorized(token, request.headers.get("Authorization", ""), request.query.get("token", "")):
+            return web.Response(status=403, text="forbidden")
+        return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.types import TelegramObject
+
+from db import get_session, get_or_create_user, query_counter
+from metrics import Counter, Histogram
+
+log = logging.getLogger(__name__)
+
+# накопительная статистика процесса: сколько апдейтов и SQL-запросов на них ушло
+QUERY_STATS = {"updates": 0, "queries": 0}
+
+UPDATE_SECONDS = Histogram("pocketai_update_seconds", "Update handling time", ["type"])
+UPDATE_QUERIES = Histogram("pocketai_update_sql_queries", "SQL statements per update", ["type"],
+                           buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50))
+Counter("pocketai_updates_total", "Updates handled by this process", fn=lambda: QUERY_STATS["updates"])
+Counter("pocketai_update_sql_queries_total", "SQL statements issued while handling updates",
+        fn=lambda: QUERY_STATS["queries"])
+
+
+class QueryCounterMiddleware(BaseMiddleware):
+    """Считает SQL-запросы на один апдейт (outer-middleware на dp.update)."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        counter = [0]
+        token = query_counter.set(counter)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            query_counter.reset(token)
+            QUERY_STATS["updates"] += 1
+            QUERY_STATS["queries"] += counter[0]
+            kind = getattr(event, "event_type", "unknown")
+            UPDATE_SECONDS.observe(time.perf_counter() - started, type=kind)
+            UPDATE_QUERIES.observe(counter[0], type=kind)
+            log.debug("update %s: %d SQL queries", getattr(event, "update_id", "?"), counter[0])
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Одна сессия на апдейт (data["session"]) и один загруженный/созданный User (data["user"]).
+    Юзера грузим, только если хендлер его просит — чтобы, например, /whoami не создавал записи.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        async with get_session() as session:
+            data["session"] = session
+            handler_obj: HandlerObject | None = data.get("handler")
+            from_user = data.get("event_from_user")
+            if from_user and (handler_obj is None or "user" in handler_obj.params):
+                data["user"] = await get_or_create_user(session, from_user.id)
+            return await handler(event, data)
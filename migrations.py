@@ -0,0 +1,99 @@
+"""
+Версионированные миграции схемы без внешних зависимостей.
+
+- новая БД: create_all создаёт актуальную схему, все миграции просто помечаются применёнными;
+- существующая БД: create_all докатывает только новые таблицы, а изменения существующих
+  (колонки, индексы, переносы данных) делают миграции ниже — по порядку, один раз.
+
+Применённые версии лежат в таблице schema_version. Миграция — sync-функция от Connection,
+выполняется в транзакции init_db. Новые миграции только добавляем в конец списка.
+"""
+from __future__ import annotations
+
+from typing import Callable, List, NamedTuple
+
+from sqlalchemy import inspect, select, text
+from sqlalchemy.engine import Connection
+
+from db import Base, SchemaVersion
+
+# произвольная константа для pg_advisory_xact_lock: бот и postback_app стартуют одновременно
+PG_LOCK_ID = 0x706F636B
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Connection], None]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, name: str):
+    def deco(fn: Callable[[Connection], None]) -> Callable[[Connection], None]:
+        assert not MIGRATIONS or MIGRATIONS[-1].version < version, "migrations must be ordered"
+        MIGRATIONS.append(Migration(version, name, fn))
+        return fn
+    return deco
+
+
+# ========= helpers =========
+
+def has_column(conn: Connection, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def create_missing_indexes(conn: Connection, *tables: str) -> None:
+    for table in Base.metadata.sorted_tables:
+        if tables and table.name not in tables:
+            continue
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+# ========= миграции =========
+
+@migration(1, "baseline: users, config, content_overrides, btn_overrides")
+def _baseline(conn: Connection) -> None:
+    # исходные таблицы создаёт create_all; недостающие у старых баз индексы
+    # (в т.ч. keyset/segment-индексы users) — здесь
+    create_missing_indexes(conn, "users", "config", "content_overrides", "btn_overrides")
+
+
+@migration(2, "users.total_deposits_cents")
+def _deposits_cents(conn: Connection) -> None:
+    if not has_column(conn, "users", "total_deposits_cents"):
+        conn.execute(text("ALTER TABLE users ADD COLUMN total_deposits_cents BIGINT NOT NULL DEFAULT 0"))
+    conn.execute(text(
+        "UPDATE users SET total_deposits_cents = CAST(ROUND(total_deposits * 100) AS BIGINT) "
+        "WHERE total_deposits_cents = 0 AND total_deposits > 0"
+    ))
+
+
+@migration(3, "postback_events.amount_cents")
+def _ledger_cents(conn: Connection) -> None:
+    if not has_column(conn, "postback_events", "amount_cents"):
+        conn.execute(text("ALTER TABLE postback_events ADD COLUMN amount_cents BIGINT NOT NULL DEFAULT 0"))
+    conn.execute(text(
+        "UPDATE postback_events SET amount_cents = CAST(ROUND(amount * 100) AS BIGINT) "
+        "WHERE amount_cents = 0 AND amount <> 0"
+    ))
+
+
+# ========= runner =========
+
+def migrate(conn: Connection) -> None:
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": PG_LOCK_ID})
+
+    fresh = not inspect(conn).has_table("users")
+    Base.metadata.create_all(conn)
+
+    applied = set(conn.execute(select(SchemaVersion.version)).scalars())
+    for m in MIGRATIONS:
+        if m.version in applied:
+            continue
+        if not fresh:
+            m.apply(conn)
+        conn.execute(SchemaVersion.__table__.insert().values(version=m.version, name=m.name))
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from sqlalchemy import select, update, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import get_session, OutboxJob
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+Handler = Callable[[Bot, int, dict], Awaitable[None]]
+
+# kind -> обработчик(bot, user_id, payload)
+HANDLERS: Dict[str, Handler] = {}
+
+POLL_INTERVAL = 1.0     # сек, если никто не разбудил
+LEASE = 60              # сек: столько задача «занята» воркером, потом её можно взять снова
+CLEANUP_EVERY = 3600.0  # сек между чистками выполненных задач
+
+# аренду задач в работе продлеваем заранее: хендлер может ждать лимитер sender.py дольше LEASE,
+# и другой процесс (реплика postback_app) не должен взять задачу повторно
+RENEW_EVERY = LEASE / 3
+
+_wakeup = asyncio.Event()
+_held: Set[int] = set()  # id задач, которые этот процесс захватил и ещё не завершил
+
+
+def outbox_handler(kind: str) -> Callable[[Handler], Handler]:
+    def deco(fn: Handler) -> Handler:
+        HANDLERS[kind] = fn
+        return fn
+    return deco
+
+
+def enqueue(session: AsyncSession, kind: str, user_id: int, payload: Optional[dict] = None) -> None:
+    """Кладёт задачу в ту же транзакцию, что и изменение состояния (коммитит вызывающий)."""
+    session.add(OutboxJob(kind=kind, user_id=user_id, payload=json.dumps(payload or {})))
+
+
+def wake() -> None:
+    """Будит воркер сразу после коммита, не дожидаясь POLL_INTERVAL."""
+    _wakeup.set()
+
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(300, 2 ** attempts))
+
+
+async def _claim(limit: int) -> List[OutboxJob]:
+    """Захватывает готовые задачи: условный UPDATE по next_attempt_at не даст взять одну дважды."""
+    now = datetime.utcnow()
+    claimed: List[OutboxJob] = []
+    async with get_session() as s:
+        rows = (await s.execute(
+            select(OutboxJob)
+            .where(OutboxJob.status == "pending", OutboxJob.next_attempt_at <= now)
+            .order_by(OutboxJob.id)
+            .limit(limit)
+        )).scalars().all()
+        for job in rows:
+            res = await s.execute(
+                update(OutboxJob)
+                .where(OutboxJob.id == job.id, OutboxJob.next_attempt_at == job.next_attempt_at)
+                .values(next_attempt_at=now + timedelta(seconds=LEASE), attempts=OutboxJob.attempts + 1)
+                # в памяти job.attempts остаётся «до захвата» — _process считает номер попытки от него
+                .execution_options(synchronize_session=False)
+            )
+            if res.rowcount == 1:
+                claimed.append(job)
+        await s.commit()
+    return claimed
+
+
+async def _finish(job_id: int, error: Optional[str] = None,
+                  retry_in: Optional[timedelta] = None) -> None:
+    _held.discard(job_id)  # до записи: продление аренды не должно перетереть next_attempt_at повтора
+    values: dict = {"last_error": error}
+    if error is None:
+        values["status"] = "done"
+    elif retry_in is None:
+        values["status"] = "failed"
+    else:
+        values["next_attempt_at"] = datetime.utcnow() + retry_in
+    async with get_session() as s:
+        await s.execute(update(OutboxJob).where(OutboxJob.id == job_id).values(**values))
+        await s.commit()
+
+
+async def _process(bot: Bot, job: OutboxJob) -> Optional[timedelta]:
+    """Выполняет задачу; возвращает задержку, если задача отложена на повтор."""
+    attempts = job.attempts + 1
+    handler = HANDLERS.get(job.kind)
+    if handler is None:
+        await _finish(job.id, f"no handler for {job.kind}")
+        return None
+    retry_in: Optional[timedelta] = None
+    try:
+        await handler(bot, job.user_id, json.loads(job.payload or "{}"))
+    except TelegramRetryAfter as e:
+        retry_in = timedelta(seconds=e.retry_after)
+        await _finish(job.id, "retry_after", retry_in)
+    except TelegramForbiddenError:
+        await _finish(job.id, "forbidden")  # бот заблокирован — повторять бессмысленно
+    except Exception as e:
+        if attempts < settings.OUTBOX_MAX_ATTEMPTS:
+            retry_in = _backoff(attempts)
+        await _finish(job.id, f"{type(e).__name__}: {e}"[:256], retry_in)
+    else:
+        await _finish(job.id)
+    return retry_in
+
+
+async def _process_user(bot: Bot, jobs: List[OutboxJob], sem: asyncio.Semaphore) -> None:
+    # задачи одного пользователя — строго по порядку, чтобы экраны не перемешались
+    try:
+        async with sem:
+            for i, job in enumerate(jobs):
+                retry_in = await _process(bot, job)
+                if retry_in is not None:
+                    # остальные задачи юзера ждут повтора этой (попытку им не засчитываем)
+                    rest = [j.id for j in jobs[i + 1:]]
+                    if rest:
+                        _held.difference_update(rest)
+                        async with get_session() as s:
+                            await s.execute(
+                                update(OutboxJob).where(OutboxJob.id.in_(rest)).values(
+                                    next_attempt_at=datetime.utcnow() + retry_in,
+                                    attempts=OutboxJob.attempts - 1,
+                                )
+                            )
+                            await s.commit()
+                    return
+    finally:
+        _held.difference_update(j.id for j in jobs)
+
+
+async def _renew_leases() -> None:
+    """Сдвигает аренду захваченных, но ещё не завершённых задач на LEASE вперёд."""
+    while True:
+        await asyncio.sleep(RENEW_EVERY)
+        ids = list(_held)
+        if not ids:
+            continue
+        try:
+            async with get_session() as s:
+                await s.execute(
+                    update(OutboxJob)
+                    .where(OutboxJob.id.in_(ids), OutboxJob.status == "pending")
+                    .values(next_attempt_at=datetime.utcnow() + timedelta(seconds=LEASE))
+                    .execution_options(synchronize_session=False)
+                )
+                await s.commit()
+        except Exception:
+            log.warning("outbox lease renewal failed", exc_info=True)
+
+
+async def cleanup(keep_days: int) -> int:
+    """Удаляет выполненные и окончательно упавшие задачи старше keep_days дней."""
+    cutoff = datetime.utcnow() - timedelta(days=keep_days)
+    async with get_session() as s:
+        res = await s.execute(
+            delete(OutboxJob)
+            .where(OutboxJob.status.in_(("done", "failed")), OutboxJob.created_at < cutoff)
+            .execution_options(synchronize_session=False)
+        )
+        await s.commit()
+    return res.rowcount or 0
+
+
+async def run_outbox(bot: Bot) -> None:
+    """Бесконечный цикл воркера: разбирает outbox с ограниченной параллельностью."""
+    sem = asyncio.Semaphore(settings.OUTBOX_CONCURRENCY)
+    renewer = asyncio.create_task(_renew_leases())
+    try:
+        await _loop(bot, sem)
+    finally:
+        renewer.cancel()
+
+
+async def _loop(bot: Bot, sem: asyncio.Semaphore) -> None:
+    next_cleanup = time.monotonic()
+    while True:
+        if settings.OUTBOX_KEEP_DAYS and time.monotonic() >= next_cleanup:
+            next_cleanup = time.monotonic() + CLEANUP_EVERY
+            try:
+                removed = await cleanup(settings.OUTBOX_KEEP_DAYS)
+                if removed:
+                    log.info("outbox cleanup: %d old jobs removed", removed)
+            except Exception:
+                log.warning("outbox cleanup failed", exc_info=True)
+
+        jobs = await _claim(settings.OUTBOX_CONCURRENCY * 4)
+        if jobs:
+            _held.update(j.id for j in jobs)
+            by_user: Dict[int, List[OutboxJob]] = defaultdict(list)
+            for job in jobs:
+                by_user[job.user_id].append(job)
+            await asyncio.gather(*(_process_user(bot, js, sem) for js in by_user.values()))
+            continue
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
@@ -1,46 +1,108 @@
 # postback_app.py
-from typing import Optional
+import asyncio
+import csv
+import io
+import json
+from contextlib import asynccontextmanager
+from typing import List, Optional, Set, Tuple
 import hmac
-import hashlib
-from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import RedirectResponse, Response
 
-from aiogram import Bot
-from aiogram.client.default import DefaultBotProperties
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
 
 from settings import settings
-from db import get_session, get_user_by_click_id, User
-from bot import check_subscription, send_screen, evaluate_and_route, send_deposit_progress
+from db import get_session, User
+from links import verify, ref_url, group_for_click
+from subscriptions import check_subscription
+from sender import send_stats
+from postbacks import (
+    ingest_postback, ingest_batch, parse_amount, BatchItem, normalize_event, REG_EVENTS, DEPOSIT_EVENTS,
+)
+from metrics import Counter, Histogram, render as render_metrics, authorized, CONTENT_TYPE
+from tracing import start_trace
+from outbox import outbox_handler, run_outbox, wake as wake_outbox
+from bot import (
+    send_screen, evaluate_and_route, send_deposit_progress,
+    create_bot, build_dispatcher, prepare,
+)
 from keyboards import kb_access
-from config_service import pb_secret, platinum_threshold, first_deposit_min
+from config_service import pb_secret, first_deposit_min, load_config
 
 
-app = FastAPI(title="PocketAI Postbacks")
+PB_SECONDS = Histogram("pocketai_postback_seconds", "GET /pb handling time", ["event"])
+PB_TOTAL = Counter("pocketai_postbacks_total", "Postbacks by event and outcome", ["event", "outcome"])
+PB_BATCH_SECONDS = Histogram("pocketai_postback_batch_seconds", "POST /pb/batch handling time")
 
-# Бот для пушей из постбэков (отдельный экземпляр, без polling)
-bot_push = Bot(token=settings.TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+# Бот для пушей из постбэков; в webhook-режиме он же обрабатывает апдейты
+bot_push = create_bot()
 
+# Dispatcher поднимается только в webhook-режиме
+dp: Optional[Dispatcher] = None
 
-# ---------- helpers: подпись редирект-ссылок ----------
-async def sign(kind: str, click_id: str) -> str:
-    secret = await pb_secret()
-    return hmac.new(secret.encode(), f"{kind}:{click_id}".encode(), hashlib.sha256).hexdigest()
+# ссылки на задачи обработки апдейтов, чтобы их не собрал GC
+_update_tasks: Set[asyncio.Task] = set()
 
 
-async def verify(kind: str, click_id: str, sig: str) -> bool:
-    try:
-        expected = await sign(kind, click_id)
-        return hmac.compare_digest(expected, sig)
-    except Exception:
-        return False
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    global dp
+    if settings.BOT_MODE == "webhook":
+        dp = build_dispatcher()
+        await prepare(bot_push)
+        await bot_push.set_webhook(
+            url=f"{settings.PUBLIC_BASE}{settings.WEBHOOK_PATH}",
+            secret_token=settings.WEBHOOK_TOKEN,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    else:
+        # прогреваем кэш конфига; дальше он сам сверяет версию с БД по TTL
+        await load_config()
+    # пуши по постбэкам уходят в фоне, ответ партнёрке их не ждёт
+    worker = asyncio.create_task(run_outbox(bot_push))
+    yield
+    worker.cancel()
+    await bot_push.session.close()
+
+
+app = FastAPI(title="PocketAI Postbacks", lifespan=lifespan)
+
+
+# ---------- вебхук Telegram (BOT_MODE=webhook) ----------
+async def tg_webhook(request: Request):
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, settings.WEBHOOK_TOKEN):
+        raise HTTPException(status_code=403, detail="forbidden")
+    if dp is None:
+        raise HTTPException(status_code=503, detail="dispatcher is not ready")
+
+    update = Update.model_validate(await request.json(), context={"bot": bot_push})
+    # отвечаем Telegram сразу, сам апдейт обрабатываем в фоне
+    task = asyncio.create_task(dp.feed_update(bot_push, update))
+    _update_tasks.add(task)
+    task.add_done_callback(_update_tasks.discard)
+    return {"ok": True}
+
+
+if settings.BOT_MODE == "webhook":
+    app.add_api_route(settings.WEBHOOK_PATH, tg_webhook, methods=["POST"], include_in_schema=False)
 
 
 # ---------- health ----------
 @app.get("/")
 async def root():
-    return {"ok": True, "name": "pocketai-postbacks"}
+    return {"ok": True, "name": "pocketai-postbacks", "send": send_stats()}
+
+
+# ---------- метрики Prometheus ----------
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    if not authorized(settings.METRICS_TOKEN, request.headers.get("Authorization", ""),
+                      request.query_params.get("token", ""), open_without_token=False):
+        raise HTTPException(status_code=403, detail="forbidden")
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
 
 
 # ---------- короткие редиректы ----------
@@ -55,49 +117,38 @@ async def d_short(click_id: str, sig: str):
 
 
 # ---------- редиректы (совместимость со старым форматом) ----------
-@app.get("/go/reg")
-async def go_reg(click_id: str, sig: str):
-    if not await verify("reg", click_id, sig):
+async def _redirect(kind: str, click_id: str, sig: str) -> RedirectResponse:
+    # подпись, группа и шаблон ссылки — из памяти; в БД идём только при промахе LRU
+    if not await verify(kind, click_id, sig):
         raise HTTPException(status_code=403, detail="bad signature")
 
-    async with get_session() as session:
-        user = await get_user_by_click_id(session, click_id)
-        if not user:
-            raise HTTPException(status_code=404, detail="user not found")
+    group = await group_for_click(click_id)
+    if group is None:
+        raise HTTPException(status_code=404, detail="user not found")
 
-        base = settings.REF_REG_B if user.group_ab == "B" else settings.REF_REG_A
-        if not base:
-            raise HTTPException(status_code=503, detail="ref link is not configured")
+    url = ref_url(kind, group, click_id)  # click_id пробрасываем для партнёрки
+    if not url:
+        raise HTTPException(status_code=503, detail="ref link is not configured")
+    return RedirectResponse(url, status_code=307)
 
-        parts = urlparse(base)
-        q = dict(parse_qsl(parts.query, keep_blank_values=True))
-        q["click_id"] = click_id  # пробрасываем click_id для партнёрки
-        url = urlunparse(parts._replace(query=urlencode(q)))
-        return RedirectResponse(url, status_code=307)
+
+@app.get("/go/reg")
+async def go_reg(click_id: str, sig: str):
+    return await _redirect("reg", click_id, sig)
 
 
 @app.get("/go/dep")
 async def go_dep(click_id: str, sig: str):
-    if not await verify("dep", click_id, sig):
-        raise HTTPException(status_code=403, detail="bad signature")
+    return await _redirect("dep", click_id, sig)
 
-    async with get_session() as session:
-        user = await get_user_by_click_id(session, click_id)
-        if not user:
-            raise HTTPException(status_code=404, detail="user not found")
 
-        base = settings.REF_DEP_B if user.group_ab == "B" else settings.REF_DEP_A
-        if not base:
-            raise HTTPException(status_code=503, detail="ref link is not configured")
-
-        parts = urlparse(base)
-        q = dict(parse_qsl(parts.query, keep_blank_values=True))
-        q["click_id"] = click_id
-        url = urlunparse(parts._replace(query=urlencode(q)))
-        return RedirectResponse(url, status_code=307)
+# ---------- приём постбэков из PP ----------
+def _metric_event(event: Optional[str]) -> str:
+    # метки метрик — только известные события, чтобы мусор в event не раздувал серии
+    kind = normalize_event(event)
+    return kind if kind in REG_EVENTS or kind in DEPOSIT_EVENTS else "other"
 
 
-# ---------- приём постбэков из PP ----------
 @app.get("/pb")
 async def pb(
     event: Optional[str] = None,
@@ -105,102 +156,179 @@ async def pb(
     trader_id: Optional[str] = None,
     sumdep: Optional[float] = 0.0,
     t: Optional[str] = None,
+    tx_id: Optional[str] = None,
 ):
-    # секьюрность
-    secret = await pb_secret()
-    if not t or t != secret:
-        raise HTTPException(status_code=403, detail="forbidden")
-
+    kind = _metric_event(event)
+    outcome = "error"
+    with PB_SECONDS.time(event=kind), start_trace("pb", event=kind, click_id=click_id) as trace:
+        try:
+            # секьюрность
+            secret = await pb_secret()
+            if not t or t != secret:
+                outcome = "forbidden"
+                raise HTTPException(status_code=403, detail="forbidden")
+
+            if not click_id:
+                outcome = "bad_request"
+                raise HTTPException(status_code=400, detail="missing click_id")
+
+            amount = parse_amount(sumdep)
+            if amount is None:
+                outcome = "bad_request"
+                raise HTTPException(status_code=400, detail="bad sumdep")
+
+            res = await ingest_postback(event, click_id, trader_id, amount, tx_id)
+            if res is None:
+                outcome = "not_found"
+                raise HTTPException(status_code=404, detail="user not found")
+            if not res.duplicate:
+                wake_outbox()
+            outcome = "duplicate" if res.duplicate else "ok"
+            return res.response
+        finally:
+            PB_TOTAL.inc(event=kind, outcome=outcome)
+            if trace is not None:
+                trace.attrs["outcome"] = outcome
+
+
+def _parse_batch(body: bytes, content_type: str) -> List[dict]:
+    """
+    Тело POST /pb/batch -> строки с полями как у GET /pb (event, click_id, trader_id, sumdep, tx_id).
+    JSON: список объектов или {"events": [...]}; text/csv: первая строка — заголовок.
+    """
+    text = body.decode("utf-8-sig")
+    if "csv" in content_type:
+        return list(csv.DictReader(io.StringIO(text)))
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("events")
+    if not isinstance(data, list):
+        raise ValueError("expected a list of events")
+    return data
+
+
+async def _read_body(request: Request, limit: int) -> bytes:
+    """Тело запроса не больше limit байт: по Content-Length — сразу, без него — по ходу чтения."""
+    too_large = HTTPException(status_code=413, detail=f"body is larger than {limit} bytes")
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise too_large
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > limit:
+            raise too_large
+    return bytes(body)
+
+
+def _batch_item(row: object) -> Tuple[Optional[BatchItem], Optional[str]]:
+    if not isinstance(row, dict):
+        return None, "not an object"
+    click_id = row.get("click_id")
+    if isinstance(click_id, bool) or not isinstance(click_id, (str, int)):
+        return None, "missing click_id" if click_id is None else "bad click_id"
+    click_id = str(click_id).strip()
     if not click_id:
-        raise HTTPException(status_code=400, detail="missing click_id")
+        return None, "missing click_id"
+    amount = parse_amount(row.get("sumdep"))
+    if amount is None:
+        return None, "bad sumdep"
+
+    def opt(name: str) -> Optional[str]:
+        value = row.get(name)
+        return (str(value).strip() or None) if value is not None else None
+
+    return BatchItem(opt("event"), click_id, opt("trader_id"), amount, opt("tx_id")), None
+
+
+@app.post("/pb/batch")
+async def pb_batch(request: Request, t: Optional[str] = None):
+    """
+    Пачка постбэков одним запросом (выгрузки партнёрки, бэкфилл): JSON или CSV.
+    Ответ — по результату на строку в исходном порядке; пуши юзерам сворачиваются
+    в один экран на юзера за пачку.
+    """
+    with PB_BATCH_SECONDS.time(), start_trace("pb.batch") as trace:
+        secret = await pb_secret()
+        if not t or t != secret:
+            raise HTTPException(status_code=403, detail="forbidden")
+
+        try:
+            body = await _read_body(request, settings.PB_BATCH_MAX_BYTES)
+            rows = _parse_batch(body, request.headers.get("content-type", ""))
+        except (ValueError, csv.Error) as e:
+            raise HTTPException(status_code=400, detail=f"bad batch: {e}")
+        if len(rows) > settings.PB_BATCH_MAX:
+            raise HTTPException(status_code=413, detail=f"batch is larger than {settings.PB_BATCH_MAX}")
+
+        results: List[dict] = [{}] * len(rows)
+        items: List[BatchItem] = []
+        positions: List[int] = []
+        for i, row in enumerate(rows):
+            item, error = _batch_item(row)
+            if item is None:
+                results[i] = {"status": "invalid", "detail": error}
+                PB_TOTAL.inc(event="other", outcome="bad_request")
+                continue
+            items.append(item)
+            positions.append(i)
+
+        for i, item, res in zip(positions, items, await ingest_batch(items)):
+            results[i] = res
+            PB_TOTAL.inc(event=_metric_event(item.event), outcome=res["status"])
+
+        counts: dict = {}
+        for res in results:
+            counts[res["status"]] = counts.get(res["status"], 0) + 1
+        if counts.get("ok"):
+            wake_outbox()
+        if trace is not None:
+            trace.attrs.update(size=len(rows), **counts)
+        return {
+            "ok": True,
+            "counts": counts,
+            "results": [{"index": i, **res} for i, res in enumerate(results)],
+        }
+
 
+# ---------- пуши по итогам постбэков (разбирает outbox-воркер) ----------
+@outbox_handler("deposit_screen")
+async def ob_deposit_screen(bot: Bot, user_id: int, payload: dict) -> None:
+    need = await first_deposit_min()
     async with get_session() as session:
-        user: Optional[User] = await get_user_by_click_id(session, click_id)
-        if not user:
-            raise HTTPException(status_code=404, detail="user not found")
-
-        changed = False
-        ev = (event or "").lower().strip()
-
-        # trader_id записываем один раз
-        if trader_id and not user.trader_id:
-            user.trader_id = trader_id
-            changed = True
-
-        # регистрация
-        if ev in {"reg", "registration"}:
-            if not user.is_registered:
-                user.is_registered = True
-                changed = True
-
-        # депозиты: накапливаем total_deposits, порог сравниваем по сумме
-        amount = float(sumdep or 0.0)
-        if ev in {"dep_first", "dep_repeat", "deposit", "dep"} or amount > 0.0:
-            if amount > 0.0:
-                user.total_deposits = (user.total_deposits or 0.0) + amount
-                changed = True
-                await session.commit()  # фиксируем сумму сразу
-
-            need = await first_deposit_min()
-            paid = float(user.total_deposits or 0.0)
-
-            if paid < need:
-                # ещё не дотянули — обновляем экран прогресса депозита
-                try:
-                    await send_deposit_progress(bot_push, user)
-                except Exception:
-                    pass
-            else:
-                # порог достигнут — ставим флаг и ведём дальше
-                if not user.has_deposit:
-                    user.has_deposit = True
-                    changed = True
-                    await session.commit()
-                try:
-                    await evaluate_and_route(bot_push, user)
-                except Exception:
-                    pass
-
-        if changed:
-            await session.commit()
+        user = await session.get(User, user_id)
+        if float(user.total_deposits or 0.0) < need:
+            # ещё не дотянули — обновляем экран прогресса депозита
+            await send_deposit_progress(bot, user, session=session)
+        else:
+            # порог достигнут — ведём дальше по воронке
+            await evaluate_and_route(bot, user, session=session)
 
-        # подписка: мог обновиться статус — проверим
-        try:
-            subscribed = await check_subscription(bot_push, user.telegram_id)
-        except Exception:
-            subscribed = False
-        if subscribed and not user.is_subscribed:
-            user.is_subscribed = True
-            await session.commit()
 
-        # платина — по накопленной сумме
-        th = await platinum_threshold()
-        if (not user.is_platinum) and ((user.total_deposits or 0.0) >= th):
-            user.is_platinum = True
+@outbox_handler("check_subscription")
+async def ob_check_subscription(bot: Bot, user_id: int, payload: dict) -> None:
+    async with get_session() as session:
+        user = await session.get(User, user_id)
+        if not user.is_subscribed and await check_subscription(bot, user.telegram_id):
+            user.is_subscribed = True
             await session.commit()
 
-        # показать платину один раз
-        if user.is_platinum and (not user.platinum_notified):
-            try:
-                await send_screen(
-                    bot_push,
-                    user,
-                    key="platinum",
-                    title_key="platinum_title",
-                    text_key="platinum_text",
-                    markup=kb_access(user.language or "ru", vip=True),
-                )
-                user.platinum_notified = True
-                await session.commit()
-            except Exception:
-                pass
 
-        return {
-            "ok": True,
-            "event": event,
-            "telegram_id": user.telegram_id,
-            "is_registered": user.is_registered,
-            "has_deposit": user.has_deposit,
-            "total_deposits": float(user.total_deposits or 0.0),
-            "is_platinum": user.is_platinum,
-        }
+@outbox_handler("platinum_screen")
+async def ob_platinum_screen(bot: Bot, user_id: int, payload: dict) -> None:
+    # показать платину один раз
+    async with get_session() as session:
+        user = await session.get(User, user_id)
+        if not user.is_platinum or user.platinum_notified:
+            return
+        await send_screen(
+            bot,
+            user,
+            key="platinum",
+            title_key="platinum_title",
+            text_key="platinum_text",
+            markup=kb_access(user.language or "ru", vip=True),
+            session=session,
+        )
+        user.platinum_notified = True
+        await session.commit()
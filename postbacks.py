@@ -0,0 +1,330 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import math
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import select, update, case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from db import get_session, get_user_by_click_id, to_cents, User, PostbackEvent
+from config_service import platinum_threshold, first_deposit_min
+from outbox import enqueue
+from writequeue import run_write
+from stats import track_flags
+
+log = logging.getLogger(__name__)
+
+REG_EVENTS = {"reg", "registration"}
+DEPOSIT_EVENTS = {"dep_first", "dep_repeat", "deposit", "dep"}
+MAX_AMOUNT = 1e9  # больше — мусор в sumdep, а не депозит (и to_cents на таком падает)
+
+
+@dataclass
+class Ingested:
+    response: dict
+    duplicate: bool = False
+    user: Optional[User] = None
+
+
+def normalize_event(event: Optional[str]) -> str:
+    return (event or "").lower().strip()
+
+
+def parse_amount(value: object) -> Optional[float]:
+    """sumdep -> float; None — не число, inf/nan или больше MAX_AMOUNT по модулю."""
+    try:
+        amount = float(value or 0.0)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(amount) or abs(amount) > MAX_AMOUNT:
+        return None
+    return amount
+
+
+def dedup_key(event: str, click_id: str, trader_id: Optional[str],
+              amount: float, tx_id: Optional[str]) -> str:
+    """
+    Ключ идемпотентности. Без tx_id два одинаковых депозита одного клика считаются повтором —
+    партнёрка, которая шлёт реальные повторные депозиты, должна передавать tx_id.
+    """
+    raw = "|".join([event, click_id, trader_id or "", f"{amount:.2f}", tx_id or ""])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+async def _cached_response(session, key: str) -> Optional[dict]:
+    raw = await session.scalar(select(PostbackEvent.response).where(PostbackEvent.dedup_key == key))
+    return json.loads(raw) if raw is not None else None
+
+
+async def _add_deposit(session: AsyncSession, user: User, cents: int, need_cents: int, th_cents: int) -> None:
+    """
+    total += cents и флаги has_deposit / is_platinum по новой сумме — одним UPDATE ... RETURNING.
+    Объект user получает новые значения без «грязных» изменений, свёртку статистики правим сами.
+    """
+    total = User.total_deposits_cents + cents
+    row = (await session.execute(
+        update(User)
+        .where(User.id == user.id)
+        .values(
+            total_deposits_cents=total,
+            _total_deposits_legacy=total / 100.0,
+            has_deposit=case((total >= need_cents, True), else_=User.has_deposit),
+            is_platinum=case((total >= th_cents, True), else_=User.is_platinum),
+        )
+        .returning(User.total_deposits_cents, User.has_deposit, User.is_platinum)
+        .execution_options(synchronize_session=False)
+    )).one()
+
+    flips = {
+        "deposited": int(row.has_deposit and not user.has_deposit),
+        "platinum": int(row.is_platinum and not user.is_platinum),
+    }
+    await track_flags(session, user.created_at, user.group_ab, user.language, **flips)
+
+    set_committed_value(user, "total_deposits_cents", row.total_deposits_cents)
+    set_committed_value(user, "_total_deposits_legacy", row.total_deposits_cents / 100)
+    set_committed_value(user, "has_deposit", row.has_deposit)
+    set_committed_value(user, "is_platinum", row.is_platinum)
+
+
+async def _apply(session: AsyncSession, event: Optional[str], key: str, click_id: str, trader_id: Optional[str],
+                 amount: float, tx_id: Optional[str], need: float, th: float) -> Optional[Ingested]:
+    """
+    Применяет событие к пользователю в транзакции вызывающего (без commit).
+    Может выполняться повторно: очередь записей переигрывает задачи после отката пачки.
+    """
+    ev = normalize_event(event)
+    cached = await _cached_response(session, key)
+    if cached is not None:
+        return Ingested(cached, duplicate=True)
+
+    user = await get_user_by_click_id(session, click_id, for_update=True)
+    if not user:
+        return None
+
+    # trader_id записываем один раз
+    if trader_id and not user.trader_id:
+        user.trader_id = trader_id
+
+    # регистрация
+    if ev in REG_EVENTS and not user.is_registered:
+        user.is_registered = True
+
+    # депозиты: сумма и пороговые флаги — одним UPDATE в БД, без чтения-изменения-записи
+    is_deposit = ev in DEPOSIT_EVENTS or amount > 0.0
+    if is_deposit:
+        await _add_deposit(session, user, to_cents(max(amount, 0.0)), to_cents(need), to_cents(th))
+
+    # платина — по накопленной сумме (на случай, если порог понизили)
+    if (not user.is_platinum) and user.total_deposits_cents >= to_cents(th):
+        user.is_platinum = True
+
+    # пуши — через outbox в этой же транзакции, HTTP-ответ их не ждёт
+    if is_deposit:
+        enqueue(session, "deposit_screen", user.id)
+    if not user.is_subscribed:
+        enqueue(session, "check_subscription", user.id)
+    if user.is_platinum and not user.platinum_notified:
+        enqueue(session, "platinum_screen", user.id)
+
+    response = {
+        "ok": True,
+        "event": event,
+        "telegram_id": user.telegram_id,
+        "is_registered": user.is_registered,
+        "has_deposit": user.has_deposit,
+        "total_deposits": user.total_deposits,
+        "is_platinum": user.is_platinum,
+    }
+    session.add(PostbackEvent(
+        dedup_key=key, event=ev, click_id=click_id, trader_id=trader_id,
+        amount_cents=to_cents(amount), _amount_legacy=amount, tx_id=tx_id, response=json.dumps(response),
+    ))
+    return Ingested(response, user=user)
+
+
+async def ingest_postback(event: Optional[str], click_id: str, trader_id: Optional[str],
+                          amount: float, tx_id: Optional[str] = None) -> Optional[Ingested]:
+    """
+    Применяет событие к пользователю и пишет его в журнал одной транзакцией
+    (через очередь записей — под всплеском постбэков коммиты идут пачками).
+    None — пользователь с таким click_id не найден.
+    """
+    ev = normalize_event(event)
+    key = dedup_key(ev, click_id, trader_id, amount, tx_id)
+
+    need = await first_deposit_min()
+    th = await platinum_threshold()
+
+    try:
+        return await run_write(lambda s: _apply(s, event, key, click_id, trader_id, amount, tx_id, need, th))
+    except IntegrityError:
+        # тот же постбэк параллельно успел записаться — отдаём его ответ
+        async with get_session() as session:
+            cached = await _cached_response(session, key)
+        if cached is None:
+            raise
+        return Ingested(cached, duplicate=True)
+
+
+# ========= пачка событий (POST /pb/batch: выгрузки партнёрки, бэкфилл) =========
+
+BATCH_CHUNK = 500   # событий на транзакцию: IN-списки и блокировки строк остаются короткими
+BATCH_RETRIES = 5   # повторов транзакции пачки при конфликте с параллельными /pb
+
+
+@dataclass
+class BatchItem:
+    event: Optional[str]
+    click_id: str
+    trader_id: Optional[str] = None
+    amount: float = 0.0
+    tx_id: Optional[str] = None
+
+
+def _chunks(items: List[BatchItem]) -> List[List[int]]:
+    """
+    Индексы событий по транзакциям. События одного click_id не разрываются между
+    транзакциями — иначе пуши юзеру не свернуть в один; порядок внутри клика сохраняется.
+    """
+    by_click: Dict[str, List[int]] = defaultdict(list)
+    for i, item in enumerate(items):
+        by_click[item.click_id].append(i)
+    chunks: List[List[int]] = [[]]
+    for idx in by_click.values():
+        if chunks[-1] and len(chunks[-1]) + len(idx) > BATCH_CHUNK:
+            chunks.append([])
+        chunks[-1].extend(idx)
+    return [c for c in chunks if c]
+
+
+async def _apply_batch(session: AsyncSession, items: List[BatchItem], keys: List[str],
+                       need: float, th: float) -> List[dict]:
+    """
+    То же, что _apply, для пачки: журнал и юзеры — двумя IN-запросами, сумма депозитов —
+    одним UPDATE на юзера, пуши — не больше одного экрана на юзера за всю пачку.
+    Ответы по событиям считаются по нарастающей, как если бы они пришли по одному.
+    """
+    need_cents, th_cents = to_cents(need), to_cents(th)
+
+    cached: Dict[str, dict] = {
+        key: json.loads(raw) for key, raw in await session.execute(
+            select(PostbackEvent.dedup_key, PostbackEvent.response)
+            .where(PostbackEvent.dedup_key.in_(set(keys)))
+        )
+    }
+    users: Dict[str, User] = {
+        u.click_id: u for u in await session.scalars(
+            select(User).where(User.click_id.in_({i.click_id for i in items})).with_for_update()
+        )
+    }
+
+    totals: Dict[int, int] = {}             # user.id -> сумма в центах после уже разобранных событий
+    added: Dict[int, int] = defaultdict(int)  # user.id -> прибавка за пачку
+    flags: Dict[int, List[bool]] = {}       # user.id -> [has_deposit, is_platinum] по нарастающей
+    touched: Dict[int, User] = {}
+    deposited: Set[int] = set()
+
+    results: List[dict] = []
+    for item, key in zip(items, keys):
+        if key in cached:
+            results.append({"status": "duplicate", "response": cached[key]})
+            continue
+        user = users.get(item.click_id)
+        if user is None:
+            results.append({"status": "not_found"})
+            continue
+
+        ev = normalize_event(item.event)
+        if item.trader_id and not user.trader_id:
+            user.trader_id = item.trader_id
+        if ev in REG_EVENTS and not user.is_registered:
+            user.is_registered = True
+
+        total = totals.get(user.id, user.total_deposits_cents)
+        has_deposit, is_platinum = flags.get(user.id, [user.has_deposit, user.is_platinum])
+        if ev in DEPOSIT_EVENTS or item.amount > 0.0:
+            cents = to_cents(max(item.amount, 0.0))
+            total += cents
+            added[user.id] += cents
+            deposited.add(user.id)
+            has_deposit = has_deposit or total >= need_cents
+        is_platinum = is_platinum or total >= th_cents
+        totals[user.id] = total
+        flags[user.id] = [has_deposit, is_platinum]
+        touched[user.id] = user
+
+        response = {
+            "ok": True,
+            "event": item.event,
+            "telegram_id": user.telegram_id,
+            "is_registered": user.is_registered,
+            "has_deposit": has_deposit,
+            "total_deposits": total / 100,
+            "is_platinum": is_platinum,
+        }
+        session.add(PostbackEvent(
+            dedup_key=key, event=ev, click_id=item.click_id, trader_id=item.trader_id,
+            amount_cents=to_cents(item.amount), _amount_legacy=item.amount, tx_id=item.tx_id,
+            response=json.dumps(response),
+        ))
+        cached[key] = response  # повтор внутри пачки — тоже duplicate
+        results.append({"status": "ok", "response": response})
+
+    for uid in deposited:
+        await _add_deposit(session, touched[uid], added[uid], need_cents, th_cents)
+
+    for uid, user in touched.items():
+        if (not user.is_platinum) and user.total_deposits_cents >= th_cents:
+            user.is_platinum = True
+        # один экран на юзера: платина перекрывает экран депозита
+        if user.is_platinum and not user.platinum_notified:
+            enqueue(session, "platinum_screen", uid)
+        elif uid in deposited:
+            enqueue(session, "deposit_screen", uid)
+        if not user.is_subscribed:
+            enqueue(session, "check_subscription", uid)  # проверка членства, без сообщения
+    return results
+
+
+async def _apply_chunk(chunk: List[BatchItem], keys: List[str], need: float, th: float) -> List[dict]:
+    for attempt in range(BATCH_RETRIES + 1):
+        try:
+            return await run_write(lambda s: _apply_batch(s, chunk, keys, need, th))
+        except IntegrityError:
+            # часть событий параллельно пришла через /pb — на повторе они станут duplicate
+            if attempt == BATCH_RETRIES:
+                log.warning("postback batch chunk of %d kept conflicting, giving up", len(chunk))
+        except Exception:
+            log.exception("postback batch chunk of %d failed", len(chunk))
+            break
+    return [{"status": "error", "detail": "not applied, retry"} for _ in chunk]
+
+
+async def ingest_batch(items: List[BatchItem]) -> List[dict]:
+    """
+    Пачка постбэков: по результату на событие, в порядке items —
+    {"status": "ok" | "duplicate", "response": {...}} или {"status": "not_found"}.
+    Транзакция на BATCH_CHUNK событий, все через очередь записей. Транзакция, которая так
+    и не прошла, не роняет остальные: её события получают {"status": "error"} — их можно
+    прислать повторно, уже применённые вернутся как duplicate.
+    """
+    need = await first_deposit_min()
+    th = await platinum_threshold()
+    keys = [dedup_key(normalize_event(i.event), i.click_id, i.trader_id, i.amount, i.tx_id) for i in items]
+
+    results: List[Optional[dict]] = [None] * len(items)
+    for idx in _chunks(items):
+        chunk = [items[i] for i in idx]
+        chunk_keys = [keys[i] for i in idx]
+        got = await _apply_chunk(chunk, chunk_keys, need, th)
+        for i, res in zip(idx, got):
+            results[i] = res
+    return results
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не больше capacity в запасе.
+    pause() полностью останавливает выдачу (используем на TelegramRetryAfter).
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float) -> None:
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + float(seconds))
+        self._tokens = min(1.0, self.capacity)  # сразу после паузы — ровно один запрос
+        self._updated = max(self._updated, self._paused_until)
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                await asyncio.sleep((1.0 - self._tokens) / self.rate)
+
+
+class KeyedTokenBuckets:
+    """Отдельный bucket на ключ (например, chat_id); редко используемые вытесняются (LRU)."""
+
+    def __init__(self, rate: float, capacity: float | None = None, max_keys: int = 10_000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def get(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    async def acquire(self, key: Hashable) -> None:
+        await self.get(key).acquire()
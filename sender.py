@@ -0,0 +1,243 @@
+"""
+Общий слой исходящих сообщений: request-middleware на сессии Bot.
+
+Все send*/edit*/copy*/forward* (экраны, пуши из postback_app, рассылки, ответы админке)
+проходят через один набор лимитов процесса:
+- глобальный token bucket (SEND_RATE сообщений в секунду на бота);
+- bucket на чат: личка — ~1 сообщение в секунду с небольшим запасом, группы — 20 в минуту;
+- семафор на число одновременных запросов к Bot API.
+
+TelegramRetryAfter не пробрасывается сразу: чат ставится на паузу, запрос повторяется
+после ожидания. Глобальный bucket замирает, только если 429 за короткое окно пришли в
+несколько разных чатов (FLOOD_CHATS за FLOOD_WINDOW) — это флуд на весь бот; один
+зафлуженный чат не должен задерживать экраны остальных. Наружу ошибка уходит, только если ждать слишком долго
+(SEND_MAX_WAIT) или кончились попытки — тогда её обрабатывает вызывающий (outbox отложит задачу).
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, Optional, Set, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiogram.methods import TelegramMethod, Response
+from aiogram.methods.base import TelegramType
+
+from metrics import Counter, Gauge, Histogram
+from ratelimit import TokenBucket, KeyedTokenBuckets
+from tracing import span, detach
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+LIMITED_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+
+FLOOD_CHATS = 3     # 429 в стольких разных чатах ...
+FLOOD_WINDOW = 5.0  # ... за столько секунд — флуд на весь бот, тормозим глобальный bucket
+
+# счётчики для мониторинга (см. send_stats)
+SEND_STATS: Dict[str, int] = {"queued": 0, "in_flight": 0, "sent": 0, "retry_after": 0, "failed": 0}
+
+API_SECONDS = Histogram("pocketai_bot_api_seconds", "Bot API request time (without limiter wait)", ["method"])
+API_ERRORS = Counter("pocketai_bot_api_errors_total", "Bot API requests that raised", ["method", "error"])
+Gauge("pocketai_send_queued", "Outgoing messages waiting for or in a Bot API call", fn=lambda: SEND_STATS["queued"])
+Gauge("pocketai_send_in_flight", "Outgoing messages in a Bot API call", fn=lambda: SEND_STATS["in_flight"])
+Counter("pocketai_send_total", "Outgoing messages by result", ["result"],
+        fn=lambda: {k: SEND_STATS[k] for k in ("sent", "retry_after", "failed")})
+
+
+async def _timed_request(make_request, bot: Bot, method: TelegramMethod):
+    name = type(method).__name__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        API_ERRORS.inc(method=name, error=type(e).__name__)
+        raise
+    finally:
+        API_SECONDS.observe(time.perf_counter() - started, method=name)
+
+
+def _chat_key(method: TelegramMethod) -> Optional[Hashable]:
+    if not type(method).__name__.startswith(LIMITED_PREFIXES):
+        return None
+    chat_id = getattr(method, "chat_id", None)
+    if chat_id is None and getattr(method, "inline_message_id", None):
+        return "inline"
+    return chat_id
+
+
+class SendLimiter(BaseRequestMiddleware):
+    def __init__(self, rate: float, concurrency: int, max_retries: int, max_wait: float):
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.global_bucket = TokenBucket(rate)
+        self.private = KeyedTokenBuckets(1.0, 3.0)
+        self.groups = KeyedTokenBuckets(20 / 60, 3.0)
+        self.sem = asyncio.Semaphore(concurrency)
+        self._floods: Dict[Hashable, float] = {}  # чат -> monotonic-время последнего 429
+
+    def _bot_wide_flood(self, chat: Hashable) -> bool:
+        now = time.monotonic()
+        self._floods[chat] = now
+        for key in [k for k, t in self._floods.items() if now - t > FLOOD_WINDOW]:
+            del self._floods[key]
+        return len(self._floods) >= FLOOD_CHATS
+
+    def _bucket(self, chat: Hashable) -> TokenBucket:
+        # user_id > 0; группы/каналы — отрицательные id или @username
+        if isinstance(chat, int) and chat > 0:
+            return self.private.get(chat)
+        return self.groups.get(chat)
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType],
+                       bot: Bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        chat = _chat_key(method)
+        if chat is None:
+            return await _timed_request(make_request, bot, method)
+
+        chat_bucket = self._bucket(chat)
+        SEND_STATS["queued"] += 1
+        try:
+            for attempt in range(self.max_retries + 1):
+                with span("send.wait", attempt=attempt):
+                    await chat_bucket.acquire()
+                    await self.global_bucket.acquire()
+                async with self.sem:
+                    SEND_STATS["in_flight"] += 1
+                    try:
+                        result = await _timed_request(make_request, bot, method)
+                    except TelegramRetryAfter as e:
+                        SEND_STATS["retry_after"] += 1
+                        log.warning("flood wait %ss on %s (chat %s)", e.retry_after,
+                                    type(method).__name__, chat)
+                        if attempt == self.max_retries or e.retry_after > self.max_wait:
+                            SEND_STATS["failed"] += 1
+                            raise
+                        chat_bucket.pause(e.retry_after)
+                        if self._bot_wide_flood(chat):
+                            self.global_bucket.pause(e.retry_after)
+                        continue
+                    except Exception:
+                        SEND_STATS["failed"] += 1
+                        raise
+                    finally:
+                        SEND_STATS["in_flight"] -= 1
+                SEND_STATS["sent"] += 1
+                return result
+        finally:
+            SEND_STATS["queued"] -= 1
+
+
+# один лимитер на процесс: общий для всех Bot (в webhook-режиме бот и пуши — один процесс)
+limiter = SendLimiter(
+    rate=settings.SEND_RATE,
+    concurrency=settings.SEND_CONCURRENCY,
+    max_retries=settings.SEND_MAX_RETRIES,
+    max_wait=settings.SEND_MAX_WAIT,
+)
+
+
+def install(bot: Bot) -> Bot:
+    bot.session.middleware(limiter)
+    return bot
+
+
+def send_stats() -> Dict[str, int]:
+    return dict(SEND_STATS)
+
+
+# ========= фоновое удаление старых экранов =========
+
+@dataclass
+class _PendingDelete:
+    bot: Bot
+    ids: Set[int] = field(default_factory=set)
+    attempt: int = 0
+    due: float = 0.0
+
+
+class DeleteQueue:
+    """
+    Удаление предыдущих экранов в фоне, чтобы не ждать его перед отправкой нового.
+    Сообщения одного чата уходят одним deleteMessages (до 100 id), неудачные — повторяются
+    пачкой с нарастающей паузой; «уже удалено / слишком старое» просто отбрасываем.
+    Чаты, подошедшие по времени, удаляются параллельно (не больше CONCURRENCY запросов):
+    deleteMessages не проходит через SendLimiter, и по одному чату за RTT очередь не успевает.
+    """
+    BATCH = 100
+    CONCURRENCY = 16
+
+    def __init__(self, retries: int = 5, delay: float = 5.0):
+        self.retries = retries
+        self.delay = delay
+        self._sem = asyncio.Semaphore(self.CONCURRENCY)
+        self._pending: Dict[Tuple[int, int], _PendingDelete] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self, bot: Bot, chat_id: int, message_id: int) -> None:
+        item = self._pending.setdefault((bot.id, chat_id), _PendingDelete(bot))
+        item.ids.add(message_id)
+        item.due = 0.0  # свежий экран не ждёт паузы после прошлых неудач
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._worker())
+        self._wakeup.set()
+
+    async def _delete(self, key: Tuple[int, int], item: _PendingDelete) -> None:
+        ids = sorted(item.ids)
+        failed: Set[int] = set()
+        for i in range(0, len(ids), self.BATCH):
+            chunk = ids[i:i + self.BATCH]
+            try:
+                await item.bot.delete_messages(key[1], chunk)
+            except TelegramBadRequest:
+                pass  # удалять уже нечего
+            except Exception as e:
+                log.debug("delete_messages failed for chat %s: %s", key[1], e)
+                failed.update(chunk)
+        if not failed:
+            return
+        if item.attempt >= self.retries:
+            log.warning("giving up deleting %d messages in chat %s", len(failed), key[1])
+            return
+        # новые id могли добавиться, пока шёл запрос — сливаем
+        retry = self._pending.setdefault(key, _PendingDelete(item.bot))
+        retry.ids.update(failed)
+        retry.attempt = max(retry.attempt, item.attempt + 1)
+        retry.due = max(retry.due, time.monotonic() + self.delay * retry.attempt)
+
+    async def _delete_limited(self, key: Tuple[int, int], item: _PendingDelete) -> None:
+        async with self._sem:
+            await self._delete(key, item)
+
+    async def _worker(self) -> None:
+        detach()
+        while True:
+            now = time.monotonic()
+            due = [k for k, v in self._pending.items() if v.due <= now]
+            if due:
+                await asyncio.gather(*(self._delete_limited(key, self._pending.pop(key)) for key in due))
+            if any(v.due <= time.monotonic() for v in self._pending.values()):
+                continue
+            self._wakeup.clear()
+            timeout = min((v.due for v in self._pending.values()), default=None)
+            try:
+                await asyncio.wait_for(
+                    self._wakeup.wait(),
+                    None if timeout is None else max(0.0, timeout - time.monotonic()),
+                )
+            except asyncio.TimeoutError:
+                pass
+
+
+deleter = DeleteQueue()
+
+
+def schedule_delete(bot: Bot, chat_id: int, message_id: int) -> None:
+    deleter.schedule(bot, chat_id, message_id)
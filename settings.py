@@ -1,3 +1,4 @@
+import hashlib
 import os
 from dataclasses import dataclass, field
 from dotenv import load_dotenv
@@ -41,10 +42,106 @@ class Settings:
 
     # Секрет постбэков
     PB_SECRET: str = os.getenv("PB_SECRET", "supersecret123").strip()
+    # POST /pb/batch: максимум событий и байт в одном запросе
+    PB_BATCH_MAX: int = int(os.getenv("PB_BATCH_MAX", "5000"))
+    PB_BATCH_MAX_BYTES: int = int(os.getenv("PB_BATCH_MAX_BYTES", str(2 * 1024 * 1024)))
 
     # БД
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./pocketai.db")
 
+    # PostgreSQL (postgresql+asyncpg://...): пул соединений, таймаут запроса (мс),
+    # кэш подготовленных выражений (0 — если между приложением и БД стоит pgbouncer)
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_TIMEOUT: float = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_STATEMENT_TIMEOUT_MS: int = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+    PG_STATEMENT_CACHE_SIZE: int = int(os.getenv("PG_STATEMENT_CACHE_SIZE", "100"))
+
+    # SQLite: ожидание блокировки (мс), mmap (байт), page cache (КиБ)
+    SQLITE_BUSY_TIMEOUT_MS: int = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+    SQLITE_CACHE_SIZE_KB: int = int(os.getenv("SQLITE_CACHE_SIZE_KB", str(64 * 1024)))
+
+    # Очередь записей (writequeue.py): auto — включена для SQLite; макс. задач в одной транзакции
+    DB_WRITE_QUEUE: str = os.getenv("DB_WRITE_QUEUE", "auto").strip().lower()
+    DB_WRITE_BATCH: int = int(os.getenv("DB_WRITE_BATCH", "100"))
+
+    # A/B: sequence — строгое чередование по счётчику, hash — детерминированно по telegram_id
+    AB_STRATEGY: str = os.getenv("AB_STRATEGY", "").strip().lower() or "sequence"
+    AB_WEIGHTS: str = os.getenv("AB_WEIGHTS", "A:2,B:1")
+
+    # Исходящие сообщения (sender.py): всего в секунду на бота, одновременных запросов к Bot API,
+    # повторов после flood wait и максимальное ожидание (сек), после которого ошибка уходит наверх
+    SEND_RATE: float = float(os.getenv("SEND_RATE", "28"))
+    SEND_CONCURRENCY: int = int(os.getenv("SEND_CONCURRENCY", "32"))
+    SEND_MAX_RETRIES: int = int(os.getenv("SEND_MAX_RETRIES", "3"))
+    SEND_MAX_WAIT: float = float(os.getenv("SEND_MAX_WAIT", "30"))
+
+    # Рассылка: сообщений в секунду, параллельных отправок, размер пачки.
+    # По умолчанию половина SEND_RATE: глобальный bucket общий, вторая половина остаётся живым экранам
+    BCAST_RATE: float = float(os.getenv("BCAST_RATE", str(SEND_RATE / 2)))
+    BCAST_CONCURRENCY: int = int(os.getenv("BCAST_CONCURRENCY", "10"))
+    BCAST_CHUNK: int = int(os.getenv("BCAST_CHUNK", "100"))
+
+    # Outbox пушей после постбэков: параллельных пользователей, попыток на задачу
+    OUTBOX_CONCURRENCY: int = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+    OUTBOX_MAX_ATTEMPTS: int = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+    # сколько дней хранить выполненные/упавшие задачи outbox (0 — не чистить)
+    OUTBOX_KEEP_DAYS: int = int(os.getenv("OUTBOX_KEEP_DAYS", "7"))
+
+    # Режим бота: polling — отдельный процесс; webhook — апдейты принимает postback_app
+    BOT_MODE: str = os.getenv("BOT_MODE", "polling").strip().lower()
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/tg/webhook").strip()
+    WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "").strip()
+    HTTP_HOST: str = os.getenv("HTTP_HOST", "0.0.0.0").strip()
+    HTTP_PORT: int = int(os.getenv("HTTP_PORT", "8000"))
+
+    # Фоновые задачи (возобновление рассылок и т.п.); на доп. репликах можно выключить
+    BACKGROUND_TASKS: bool = os.getenv("BACKGROUND_TASKS", "1").strip().lower() in {"1", "true", "yes", "on"}
+
+    # polling на нескольких ядрах (workers.py): число процессов-обработчиков, 1 — как раньше.
+    # BOT_API_URL — свой Bot API сервер (telegram-bot-api --local или стенд), пусто — api.telegram.org
+    BOT_WORKERS: int = int(os.getenv("BOT_WORKERS", "1"))
+    BOT_API_URL: str = os.getenv("BOT_API_URL", "").strip().rstrip("/")
+
+    # Метрики Prometheus (metrics.py): порт /metrics у polling-бота (0 — выключено),
+    # токен доступа к /metrics (Bearer или ?token=); пусто — /metrics postback_app закрыт, METRICS_PORT открыт
+    METRICS_PORT: int = int(os.getenv("METRICS_PORT", "0"))
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "").strip()
+
+    # Трассировка апдейтов и /pb (tracing.py): доля записываемых трасс 0..1, порог «медленной»
+    # трассы в мс (пишется всегда; 0 — выкл), файл для JSON lines (пусто — лог pocketai.trace)
+    TRACE_SAMPLE_RATE: float = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+    TRACE_SLOW_MS: float = float(os.getenv("TRACE_SLOW_MS", "0"))
+    TRACE_FILE: str = os.getenv("TRACE_FILE", "").strip()
+
+    # Подписка на канал: TTL кэша (сек) для «подписан» / «не подписан»;
+    # фоновая перепроверка подписчиков: период (сек), запросов в секунду, размер пачки
+    SUB_CACHE_TTL: float = float(os.getenv("SUB_CACHE_TTL", "600"))
+    SUB_NEGATIVE_TTL: float = float(os.getenv("SUB_NEGATIVE_TTL", "10"))
+    SUB_SWEEP_INTERVAL: float = float(os.getenv("SUB_SWEEP_INTERVAL", "21600"))
+    SUB_SWEEP_RATE: float = float(os.getenv("SUB_SWEEP_RATE", "5"))
+    SUB_SWEEP_BATCH: int = int(os.getenv("SUB_SWEEP_BATCH", "200"))
+
+    # FSM админки (fsm_storage.py): sql | redis | memory; брошенные состояния живут FSM_STATE_TTL сек
+    FSM_STORAGE: str = os.getenv("FSM_STORAGE", "sql").strip().lower()
+    FSM_STATE_TTL: float = float(os.getenv("FSM_STATE_TTL", "86400"))
+    REDIS_URL: str = os.getenv("REDIS_URL", "redis://localhost:6379/0").strip()
+
+    # Кэш таблицы config: как часто (сек) сверять токен версии с БД
+    CONFIG_CACHE_TTL: float = float(os.getenv("CONFIG_CACHE_TTL", "5"))
+
+    @property
+    def WEBHOOK_TOKEN(self) -> str:
+        """
+        secret_token для setWebhook: явный WEBHOOK_SECRET или производный от токена бота
+        (Telegram допускает только [A-Za-z0-9_-]).
+        """
+        if self.WEBHOOK_SECRET:
+            return self.WEBHOOK_SECRET
+        return hashlib.sha256(f"webhook:{self.TOKEN}".encode()).hexdigest()
+
     @property
     def PRIMARY_ADMIN(self) -> int:
         """
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select, delete, func, case, event, inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from db import get_session, dialect_insert, User, StatsDaily
+
+# флаг юзера → счётчик в свёртке
+FLAGS: Tuple[Tuple[str, str], ...] = (
+    ("is_subscribed", "subscribed"),
+    ("is_registered", "registered"),
+    ("has_deposit", "deposited"),
+    ("is_platinum", "platinum"),
+)
+COUNTERS = ("users",) + tuple(c for _, c in FLAGS)
+
+Bucket = Tuple[date, str, str]
+
+
+def _bucket(created_at: Optional[datetime], group: Optional[str], lang: Optional[str]) -> Bucket:
+    return ((created_at or datetime.utcnow()).date(), group or "A", lang or "")
+
+
+def _vector(values: Dict[str, object]) -> Dict[str, int]:
+    vec = {"users": 1}
+    for attr, counter in FLAGS:
+        vec[counter] = 1 if values.get(attr) else 0
+    return vec
+
+
+def _upsert(bucket: Bucket, deltas: Dict[str, int]):
+    day, group, lang = bucket
+    stmt = dialect_insert(StatsDaily).values(day=day, group_ab=group, lang=lang, **deltas)
+    return stmt.on_conflict_do_update(
+        index_elements=[StatsDaily.day, StatsDaily.group_ab, StatsDaily.lang],
+        set_={c: getattr(StatsDaily, c) + getattr(stmt.excluded, c) for c in deltas},
+    )
+
+
+def _collect(session: Session) -> Dict[Bucket, Dict[str, int]]:
+    """Дельты свёртки по изменениям User в текущем flush: новые, удалённые, смена флагов/языка."""
+    deltas: Dict[Bucket, Dict[str, int]] = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+
+    def apply(bucket: Bucket, vec: Dict[str, int], sign: int) -> None:
+        for k, v in vec.items():
+            deltas[bucket][k] += sign * v
+
+    tracked = ("language",) + tuple(a for a, _ in FLAGS)
+
+    for obj in session.new:
+        if isinstance(obj, User):
+            values = {a: getattr(obj, a) for a in tracked}
+            apply(_bucket(obj.created_at, obj.group_ab, obj.language), _vector(values), +1)
+
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            values = {a: getattr(obj, a) for a in tracked}
+            apply(_bucket(obj.created_at, obj.group_ab, obj.language), _vector(values), -1)
+
+    for obj in session.dirty:
+        if not isinstance(obj, User):
+            continue
+        state = inspect(obj)
+        old, new, changed = {}, {}, False
+        for a in tracked:
+            hist = state.attrs[a].history
+            new[a] = getattr(obj, a)
+            if hist.deleted:
+                old[a] = hist.deleted[0]
+                changed = changed or old[a] != new[a]
+            else:
+                old[a] = new[a]
+        if changed:
+            apply(_bucket(obj.created_at, obj.group_ab, old["language"]), _vector(old), -1)
+            apply(_bucket(obj.created_at, obj.group_ab, new["language"]), _vector(new), +1)
+
+    return {b: {k: v for k, v in d.items() if v} for b, d in deltas.items() if any(d.values())}
+
+
+@event.listens_for(Session, "before_flush")
+def _track_user_changes(session: Session, flush_context, instances) -> None:
+    # та же транзакция, что и изменение юзера: свёртка не разъедется при откате
+    for bucket, d in _collect(session).items():
+        session.execute(_upsert(bucket, d))
+
+
+async def track_signup(session: AsyncSession, group: str) -> None:
+    """Для вставок мимо ORM (get_or_create_user)."""
+    await session.execute(_upsert(_bucket(None, group, None), {"users": 1}))
+
+
+async def track_flags(session: AsyncSession, created_at: datetime, group: str,
+                      lang: Optional[str], **deltas: int) -> None:
+    """Для UPDATE мимо ORM: track_flags(s, u.created_at, u.group_ab, u.language, deposited=1)."""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if deltas:
+        await session.execute(_upsert(_bucket(created_at, group, lang), deltas))
+
+
+# ========= полный пересчёт: один агрегирующий проход по users =========
+
+def funnel_columns():
+    return (
+        func.count(User.id),
+        func.sum(case((User.is_subscribed.is_(True), 1), else_=0)),
+        func.sum(case((User.is_registered.is_(True), 1), else_=0)),
+        func.sum(case((User.has_deposit.is_(True), 1), else_=0)),
+        func.sum(case((User.is_platinum.is_(True), 1), else_=0)),
+    )
+
+
+async def rebuild_stats() -> None:
+    """Пересобирает stats_daily с нуля (первый запуск, ручная сверка)."""
+    day_col = func.date(User.created_at)
+    lang_col = func.coalesce(User.language, "")
+    async with get_session() as s:
+        rows = (await s.execute(
+            select(day_col, User.group_ab, lang_col, *funnel_columns())
+            .group_by(day_col, User.group_ab, lang_col)
+        )).all()
+        await s.execute(delete(StatsDaily))
+        s.add_all(
+            StatsDaily(day=date.fromisoformat(str(d)[:10]), group_ab=g, lang=l,
+                       **dict(zip(COUNTERS, (int(v or 0) for v in vals))))
+            for d, g, l, *vals in rows
+        )
+        await s.commit()
+
+
+async def ensure_stats() -> None:
+    """На старте: если свёртка пустая, а юзеры есть — строим её."""
+    async with get_session() as s:
+        has_stats = await s.scalar(select(StatsDaily.day).limit(1))
+        has_users = await s.scalar(select(User.id).limit(1))
+    if has_users and not has_stats:
+        await rebuild_stats()
+
+
+# ========= отчёт =========
+
+async def total_users(group: str = "A") -> int:
+    """Число юзеров группы из свёртки — без COUNT по users."""
+    async with get_session() as s:
+        return int(await s.scalar(
+            select(func.coalesce(func.sum(StatsDaily.users), 0)).where(StatsDaily.group_ab == group)
+        ))
+
+
+class Funnel(dict):
+    def add(self, row: StatsDaily) -> None:
+        for c in COUNTERS:
+            self[c] = self.get(c, 0) + getattr(row, c)
+
+    def line(self) -> str:
+        return " · ".join(str(self.get(c, 0)) for c in COUNTERS)
+
+
+async def funnel_report(group: str = "A", days: int = 7, weeks: int = 4) -> Dict[str, object]:
+    """Итоги, разбивка по языкам, по дням и неделям прихода — из свёртки, без скана users."""
+    async with get_session() as s:
+        rows: Iterable[StatsDaily] = (await s.execute(
+            select(StatsDaily).where(StatsDaily.group_ab == group)
+        )).scalars().all()
+
+    today = datetime.utcnow().date()
+    week0 = today - timedelta(days=today.weekday())
+    total = Funnel()
+    by_lang: Dict[str, Funnel] = defaultdict(Funnel)
+    by_day: Dict[date, Funnel] = {today - timedelta(days=i): Funnel() for i in range(days)}
+    by_week: Dict[date, Funnel] = {week0 - timedelta(weeks=i): Funnel() for i in range(weeks)}
+    for row in rows:
+        total.add(row)
+        by_lang[row.lang or "-"].add(row)
+        if row.day in by_day:
+            by_day[row.day].add(row)
+        week = row.day - timedelta(days=row.day.weekday())
+        if week in by_week:
+            by_week[week].add(row)
+    return {"total": total, "by_lang": dict(by_lang), "by_day": by_day, "by_week": by_week}
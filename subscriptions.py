@@ -0,0 +1,157 @@
+"""
+Статус подписки на канал без запроса к Bot API на каждый экран.
+
+- check_subscription: per-user кэш; положительный ответ живёт SUB_CACHE_TTL,
+  отрицательный — коротко (SUB_NEGATIVE_TTL), чтобы «Я подписался» срабатывал почти сразу;
+- run_sweeper: фоновая перепроверка пользователей с is_subscribed=True пачками
+  с ограничением частоты — так ловим отписки, которые раньше не замечали вовсе.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from sqlalchemy import select
+
+from config_service import channel_id, check_subscription_enabled
+from db import get_session, User
+from metrics import STEP_SECONDS, cache_hit, cache_miss
+from ratelimit import TokenBucket
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+MEMBER_STATUSES = {"member", "administrator", "creator"}
+LEFT_STATUSES = {"left", "kicked"}
+CACHE_SIZE = 50_000
+
+# telegram_id -> (подписан?, monotonic-время истечения)
+_cache: "OrderedDict[int, tuple[bool, float]]" = OrderedDict()
+_sweeper: Optional[asyncio.Task] = None
+
+
+async def fetch_status(bot: Bot, tg_id: int) -> Optional[bool]:
+    """
+    Один вызов getChatMember. None — ответ неизвестен (сеть, бот не админ канала,
+    неверный CHANNEL_ID и т.п.): такой результат не кэшируем и не используем, чтобы снять
+    подписку. False — только по явному статусу left/kicked или «user not found».
+    """
+    cid = await channel_id()
+    if cid is None:
+        return None
+    try:
+        member = await bot.get_chat_member(cid, tg_id)
+    except TelegramRetryAfter:
+        raise
+    except TelegramBadRequest as e:
+        # «chat not found», «member list is inaccessible» — ошибка настройки, а не отписка
+        if "user not found" in str(e.message).lower():
+            return False
+        log.warning("getChatMember failed for channel %s: %s", cid, e.message)
+        return None
+    except Exception:
+        return None
+    status = getattr(member, "status", None)
+    if status in MEMBER_STATUSES:
+        return True
+    if status in LEFT_STATUSES:
+        return False
+    if status == "restricted":
+        return bool(getattr(member, "is_member", False))
+    return None
+
+
+def remember(tg_id: int, subscribed: bool) -> None:
+    ttl = settings.SUB_CACHE_TTL if subscribed else settings.SUB_NEGATIVE_TTL
+    _cache[tg_id] = (subscribed, time.monotonic() + ttl)
+    _cache.move_to_end(tg_id)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def forget(tg_id: int) -> None:
+    _cache.pop(tg_id, None)
+
+
+@STEP_SECONDS.timed(step="check_subscription")
+async def check_subscription(bot: Bot, tg_id: int, fresh: bool = False) -> bool:
+    """Подписан ли пользователь; fresh=True — мимо кэша (кнопка «Я подписался»)."""
+    if not fresh:
+        hit = _cache.get(tg_id)
+        if hit is not None and hit[1] > time.monotonic():
+            cache_hit("subscription")
+            return hit[0]
+        cache_miss("subscription")
+    try:
+        status = await fetch_status(bot, tg_id)
+    except TelegramRetryAfter:
+        status = None
+    if status is None:
+        return False
+    remember(tg_id, status)
+    return status
+
+
+# ========= фоновая перепроверка =========
+
+async def _sweep_batch(bot: Bot, bucket: TokenBucket, after_id: int) -> Optional[int]:
+    """Проверяет одну пачку подписчиков; возвращает курсор для следующей или None в конце."""
+    async with get_session() as s:
+        rows = (await s.execute(
+            select(User.id, User.telegram_id)
+            .where(User.is_subscribed.is_(True), User.id > after_id)
+            .order_by(User.id)
+            .limit(settings.SUB_SWEEP_BATCH)
+        )).all()
+    if not rows:
+        return None
+
+    gone: List[int] = []
+    for user_id, tg_id in rows:
+        await bucket.acquire()
+        try:
+            status = await fetch_status(bot, tg_id)
+        except TelegramRetryAfter as e:
+            bucket.pause(e.retry_after)
+            continue
+        if status is None:
+            continue
+        remember(tg_id, status)
+        if not status:
+            gone.append(user_id)
+
+    if gone:
+        # через ORM, чтобы изменение попало в rollup статистики
+        async with get_session() as s:
+            users = (await s.execute(select(User).where(User.id.in_(gone)))).scalars().all()
+            for u in users:
+                u.is_subscribed = False
+            await s.commit()
+        log.info("subscription sweep: %d users unsubscribed", len(gone))
+    return rows[-1][0]
+
+
+async def run_sweeper(bot: Bot) -> None:
+    bucket = TokenBucket(settings.SUB_SWEEP_RATE)
+    while True:
+        try:
+            if await check_subscription_enabled():
+                cursor: Optional[int] = 0
+                while cursor is not None:
+                    cursor = await _sweep_batch(bot, bucket, cursor)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("subscription sweep failed")
+        await asyncio.sleep(settings.SUB_SWEEP_INTERVAL)
+
+
+def start_sweeper(bot: Bot) -> None:
+    global _sweeper
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.create_task(run_sweeper(bot))
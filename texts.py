@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Tuple
 
 # Локализованные строки интерфейса
 T: Dict[str, Dict[str, str]] = {
@@ -209,6 +209,23 @@ T: Dict[str, Dict[str, str]] = {
 }
 
 
+# Поддерживаемые языки интерфейса
+LANGS = ('ru', 'en', 'hi', 'es')
+
+# Экран → (ключ заголовка, ключ текста)
+SCREEN_MAP: Dict[str, Tuple[str, str]] = {
+    'main': ('main_title', 'main_desc'),
+    'instruction': ('instruction_title', 'instruction_text'),
+    'subscribe': ('subscribe_title', 'subscribe_text'),
+    'register': ('register_title', 'register_text'),
+    'deposit': ('deposit_title', 'deposit_text'),
+    'access': ('access_title', 'access_text'),
+    'platinum': ('platinum_title', 'platinum_text'),
+    'admin': ('main_title', 'main_desc'),
+    'langs': ('lang_title', 'lang_title'),
+}
+
+
 def t(lang: str, key: str) -> str:
     """Безопасное извлечение перевода с фоллбэком на EN/ключ."""
     d = T.get(key) or {}
@@ -0,0 +1,216 @@
+"""
+Трассировка апдейтов и постбэков по шагам (opt-in).
+
+Трасса — один апдейт aiogram или один запрос /pb; внутри — спаны: каждый SQL-запрос
+(события engine), каждый вызов Bot API (request-middleware, вместе с ожиданием лимитера),
+перечитывание конфига, ожидание очереди записи. Текущая трасса и спан живут в contextvars,
+поэтому спаны из asyncio-задач, запущенных внутри апдейта, попадают в его трассу.
+
+Настройки:
+- TRACE_SAMPLE_RATE — доля трасс, которые пишутся всегда (0 — ни одной);
+- TRACE_SLOW_MS — трасса длиннее порога пишется всегда, с пометкой slow (0 — выключено);
+- TRACE_FILE — куда писать JSON lines; пусто — в лог pocketai.trace.
+
+Оба порога нулевые — трассировка выключена и почти ничего не стоит. Экспорт в OTLP
+не делаем: JSON lines забирает тот же сборщик логов, без новых зависимостей.
+"""
+from __future__ import annotations
+
+import itertools
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod, Response
+from aiogram.methods.base import TelegramType
+from sqlalchemy import event
+
+from db import engine
+from settings import settings
+
+log = logging.getLogger("pocketai.trace")
+
+MAX_SPANS = 500  # на трассу: длинный цикл не должен съесть память
+STATEMENT_CHARS = 200
+
+ENABLED = settings.TRACE_SAMPLE_RATE > 0 or settings.TRACE_SLOW_MS > 0
+
+_ids = itertools.count(1)
+_trace: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+_parent: ContextVar[Optional[int]] = ContextVar("trace_span", default=None)
+_out = None
+
+
+class Trace:
+    def __init__(self, name: str, attrs: Dict[str, Any], sampled: bool):
+        self.id = f"{int(time.time() * 1000):x}-{next(_ids):x}"
+        self.name = name
+        self.attrs = attrs
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.ts = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+        self.spans: List[Dict[str, Any]] = []
+        self.dropped = 0
+        self.closed = False
+
+    def add(self, name: str, started: float, ended: float, parent: Optional[int],
+            span_id: Optional[int] = None, **attrs: Any) -> None:
+        if self.closed:
+            return  # фоновая задача пережила апдейт, который её породил
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append({
+            "id": span_id or next(_ids),
+            "parent": parent,
+            "name": name,
+            "start_ms": round((started - self.started) * 1000, 2),
+            "duration_ms": round((ended - started) * 1000, 2),
+            **({"attrs": attrs} if attrs else {}),
+        })
+
+
+def _write(line: str, slow: bool) -> None:
+    global _out
+    if settings.TRACE_FILE:
+        if _out is None:
+            _out = open(settings.TRACE_FILE, "a", buffering=1, encoding="utf-8")
+        _out.write(line + "\n")
+    else:
+        log.log(logging.WARNING if slow else logging.INFO, line)
+
+
+@contextmanager
+def start_trace(name: str, **attrs: Any) -> Iterator[Optional[Trace]]:
+    """Корневая трасса; вложенный вызов (апдейт внутри уже идущей трассы) — просто спан."""
+    if not ENABLED:
+        yield None
+        return
+    if _trace.get() is not None and not _trace.get().closed:
+        with span(name, **attrs):
+            yield _trace.get()
+        return
+
+    trace = Trace(name, attrs, sampled=random.random() < settings.TRACE_SAMPLE_RATE)
+    t_token = _trace.set(trace)
+    p_token = _parent.set(None)
+    error = None
+    try:
+        yield trace
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _parent.reset(p_token)
+        _trace.reset(t_token)
+        trace.closed = True
+        duration = (time.perf_counter() - trace.started) * 1000
+        slow = bool(settings.TRACE_SLOW_MS) and duration >= settings.TRACE_SLOW_MS
+        if trace.sampled or slow:
+            record = {
+                "trace": trace.id, "name": trace.name, "ts": trace.ts,
+                "duration_ms": round(duration, 2), "slow": slow, "attrs": trace.attrs,
+                "spans": trace.spans,
+            }
+            if error:
+                record["error"] = error
+            if trace.dropped:
+                record["dropped_spans"] = trace.dropped
+            _write(json.dumps(record, ensure_ascii=False, default=str), slow)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[None]:
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = next(_ids)
+    parent_id = _parent.get()
+    token = _parent.set(span_id)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _parent.reset(token)
+        trace.add(name, started, time.perf_counter(), parent_id, span_id, **attrs)
+
+
+def detach() -> None:
+    """Для долгоживущих фоновых задач: не приписывать их работу апдейту, который их создал."""
+    _trace.set(None)
+    _parent.set(None)
+
+
+# ========= SQL =========
+
+def _before(conn, cursor, statement, parameters, context, executemany):
+    if _trace.get() is not None and context is not None:
+        context._trace_started = time.perf_counter()
+
+
+def _after(conn, cursor, statement, parameters, context, executemany):
+    trace = _trace.get()
+    started = getattr(context, "_trace_started", None)
+    if trace is None or started is None:
+        return
+    trace.add("db", started, time.perf_counter(), _parent.get(),
+              sql=" ".join(statement.split())[:STATEMENT_CHARS])
+
+
+if ENABLED:
+    event.listen(engine.sync_engine, "before_cursor_execute", _before)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after)
+
+
+# ========= Bot API =========
+
+class TraceRequestMiddleware(BaseRequestMiddleware):
+    """Спан на вызов Bot API; стоит снаружи лимитера — ожидание очереди тоже видно."""
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType],
+                       bot: Bot, method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        if _trace.get() is None:
+            return await make_request(bot, method)
+        with span(f"tg.{type(method).__name__}", chat_id=getattr(method, "chat_id", None)):
+            return await make_request(bot, method)
+
+
+def install(bot: Bot) -> Bot:
+    if ENABLED:
+        bot.session.middleware(TraceRequestMiddleware())
+    return bot
+
+
+# ========= aiogram =========
+
+def _update_attrs(update: Any) -> Dict[str, Any]:
+    attrs: Dict[str, Any] = {"update_id": getattr(update, "update_id", None)}
+    try:
+        ev = update.event
+    except Exception:
+        return attrs
+    attrs["type"] = update.event_type
+    user = getattr(ev, "from_user", None)
+    if user is not None:
+        attrs["user_id"] = user.id
+    if getattr(ev, "data", None):
+        attrs["data"] = ev.data[:64]
+    elif (getattr(ev, "text", None) or "").startswith("/"):
+        attrs["command"] = ev.text.split()[0][:64]
+    return attrs
+
+
+async def update_middleware(handler, update, data):
+    """Outer-middleware на dp.update: одна трасса на апдейт."""
+    if not ENABLED:
+        return await handler(update, data)
+    with start_trace("update", **_update_attrs(update)):
+        return await handler(update, data)
@@ -0,0 +1,236 @@
+"""
+Polling на нескольких процессах (BOT_WORKERS > 1).
+
+Главный процесс только забирает апдейты (getUpdates) и раскладывает их по очередям воркеров
+по telegram_id: все апдейты одного пользователя попадают в один процесс, поэтому его
+сценарии идут по порядку, а кэши «на пользователя» (подписка, media и т.п.) остаются верными.
+Внутри воркера апдейты разных пользователей обрабатываются параллельно, одного — строго
+друг за другом.
+
+Кэши конфига/контента/кнопок у каждого процесса свои. Запись в конфиг (админка) поднимает
+токен версии в БД и шлёт сигнал в общую шину; главный процесс рассылает его остальным
+воркерам, и те сбрасывают кэш, не дожидаясь CONFIG_CACHE_TTL.
+
+Фоновые задачи (возобновление рассылок, перепроверка подписок) запускает только воркер 0.
+Лимит отправки SEND_RATE делится между воркерами поровну. Для нескольких процессов
+лучше PostgreSQL: у SQLite очередь записи (writequeue.py) своя в каждом процессе.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing as mp
+import queue
+import signal
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from settings import settings
+
+log = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 30  # сек, long polling
+POLL_LIMIT = 100
+
+
+def shard_key(update: Update) -> int:
+    """telegram_id автора апдейта; без автора — id чата, иначе 0."""
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    return chat.id if chat is not None else 0
+
+
+# ========= воркер =========
+
+class _UserChains:
+    """Очередь задач на пользователя: следующий апдейт ждёт завершения предыдущего."""
+
+    def __init__(self):
+        self._tails: Dict[int, asyncio.Task] = {}
+
+    def submit(self, uid: int, coro_fn) -> asyncio.Task:
+        prev = self._tails.get(uid)
+
+        async def run():
+            if prev is not None:
+                await asyncio.wait([prev])
+            await coro_fn()
+
+        task = asyncio.create_task(run())
+        self._tails[uid] = task
+        task.add_done_callback(lambda t: self._tails.pop(uid, None) if self._tails.get(uid) is t else None)
+        return task
+
+    async def drain(self) -> None:
+        if self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+
+def _get(q):
+    """Блокирующее чтение очереди; None — сентинел или главный процесс умер."""
+    parent = mp.parent_process()
+    while True:
+        try:
+            return q.get(timeout=1.0)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                return None
+
+
+async def _feed(dp: Dispatcher, bot: Bot, data: Dict[str, Any]) -> None:
+    try:
+        update = Update.model_validate(data, context={"bot": bot})
+        await dp.feed_update(bot, update)
+    except Exception:
+        log.exception("update %s failed", data.get("update_id"))
+
+
+async def _worker(index: int, n: int, updates, control, bus) -> None:
+    from bot import create_bot, build_dispatcher, prepare
+    from config_service import on_config_change, invalidate_config
+    from metrics import start_metrics_server
+    from ratelimit import TokenBucket
+    import sender
+
+    settings.BACKGROUND_TASKS = settings.BACKGROUND_TASKS and index == 0
+    sender.limiter.global_bucket = TokenBucket(settings.SEND_RATE / n)
+    on_config_change(lambda: bus.put(index))
+
+    bot = create_bot()
+    dp = build_dispatcher()
+    await prepare(bot)
+    if settings.METRICS_PORT:
+        await start_metrics_server(settings.HTTP_HOST, settings.METRICS_PORT + index, settings.METRICS_TOKEN)
+    loop = asyncio.get_running_loop()
+
+    async def listen_control():
+        while await loop.run_in_executor(None, _get, control) is not None:
+            invalidate_config(broadcast=False)
+
+    control_task = asyncio.create_task(listen_control())
+    chains = _UserChains()
+    try:
+        while True:
+            item: Optional[Tuple[int, Dict[str, Any]]] = await loop.run_in_executor(None, _get, updates)
+            if item is None:
+                break
+            uid, data = item
+            chains.submit(uid, lambda data=data: _feed(dp, bot, data))
+        await chains.drain()
+    finally:
+        control.put(None)
+        await control_task
+        await dp.storage.close()
+        await bot.session.close()
+
+
+def _worker_main(index: int, n: int, updates, control, bus) -> None:
+    # Ctrl+C получает вся группа процессов — останавливает воркеры главный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_worker(index, n, updates, control, bus))
+
+
+# ========= главный процесс =========
+
+class _Shard:
+    def __init__(self, ctx, index: int, n: int, bus):
+        self.index = index
+        self.n = n
+        self.bus = bus
+        self.updates = ctx.Queue()
+        self.control = ctx.Queue()
+        self.ctx = ctx
+        self.process: Optional[mp.Process] = None
+
+    def start(self) -> None:
+        self.process = self.ctx.Process(
+            target=_worker_main, name=f"bot-worker-{self.index}",
+            args=(self.index, self.n, self.updates, self.control, self.bus), daemon=True,
+        )
+        self.process.start()
+
+    def ensure_alive(self) -> None:
+        if self.process is not None and not self.process.is_alive():
+            log.error("worker %d exited with %s, restarting", self.index, self.process.exitcode)
+            self.start()
+
+
+async def _relay(shards: List[_Shard], bus) -> None:
+    """Сигнал «конфиг изменился» от одного воркера — всем остальным."""
+    loop = asyncio.get_running_loop()
+    while (origin := await loop.run_in_executor(None, bus.get)) is not None:
+        for shard in shards:
+            if shard.index != origin:
+                shard.control.put("config")
+
+
+async def run_sharded(n: int) -> None:
+    from bot import create_bot, build_dispatcher
+    from db import init_db
+
+    await init_db()  # миграции — один раз до старта воркеров
+    ctx = mp.get_context("spawn")
+    bus = ctx.Queue()
+    shards = [_Shard(ctx, i, n, bus) for i in range(n)]
+    for shard in shards:
+        shard.start()
+    relay = asyncio.create_task(_relay(shards, bus))
+
+    bot = create_bot()
+    allowed = build_dispatcher().resolve_used_update_types()
+    # getUpdates не работает, пока висит вебхук от webhook-режима
+    await bot.delete_webhook(drop_pending_updates=False)
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    poll = asyncio.create_task(_poll(bot, shards, allowed))
+    try:
+        await asyncio.wait([poll, asyncio.create_task(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        poll.cancel()
+        for shard in shards:
+            shard.updates.put(None)
+        for shard in shards:
+            await loop.run_in_executor(None, shard.process.join, 30)
+        bus.put(None)
+        await relay
+        await bot.session.close()
+    if poll.done() and not poll.cancelled() and poll.exception():
+        raise poll.exception()
+
+
+async def _poll(bot: Bot, shards: List[_Shard], allowed: List[str]) -> None:
+    n = len(shards)
+    offset: Optional[int] = None
+    backoff = 1.0
+    while True:
+        try:
+            batch = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                                          limit=POLL_LIMIT, allowed_updates=allowed)
+        except Exception as e:
+            log.warning("getUpdates failed: %s; retry in %.0fs", e, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        backoff = 1.0
+        for shard in shards:
+            shard.ensure_alive()
+        for update in batch:
+            uid = shard_key(update)
+            data = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+            shards[uid % n].updates.put((uid, data))
+            offset = update.update_id + 1
@@ -0,0 +1,115 @@
+"""
+Очередь записей процесса: короткие пишущие транзакции выполняются по одной,
+а всё, что успело накопиться, пока шёл предыдущий commit, — пачкой в одной транзакции.
+
+Для SQLite это главное: писатель в базе всегда один, и вместо гонки за блокировку
+(`database is locked`) запросы выстраиваются в очередь в памяти, а fsync делается
+один раз на пачку. Если пачка падает (конфликт уникальности, ошибка в одной из задач),
+каждая задача переигрывается отдельно в своей транзакции — ошибка достаётся только ей.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import get_session, engine
+from settings import settings
+from tracing import span, detach
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+WriteJob = Callable[[AsyncSession], Awaitable[T]]
+
+
+class WriteQueue:
+    def __init__(self, max_batch: int):
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _ensure_worker(self) -> asyncio.Queue:
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._worker())
+        return self._queue
+
+    async def submit(self, job: WriteJob[T]) -> T:
+        """
+        Выполняет job(session) и коммитит. job не должен коммитить сам и
+        может быть выполнен повторно (после отката неудачной пачки).
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._ensure_worker().put_nowait((job, fut))
+        return await fut
+
+    async def _worker(self) -> None:
+        detach()  # воркер общий: его SQL не относится к трассе того, кто его запустил
+        queue = self._queue
+        while True:
+            batch: List[Tuple[WriteJob, asyncio.Future]] = [await queue.get()]
+            while len(batch) < self.max_batch and not queue.empty():
+                batch.append(queue.get_nowait())
+            batch = [(job, fut) for job, fut in batch if not fut.cancelled()]
+            if not batch:
+                continue
+            if len(batch) == 1 or not await self._run_batch(batch):
+                for job, fut in batch:
+                    await self._run_one(job, fut)
+
+    @staticmethod
+    async def _run_batch(batch: List[Tuple[WriteJob, asyncio.Future]]) -> bool:
+        results: List[Any] = []
+        try:
+            async with get_session() as session:
+                for job, _ in batch:
+                    results.append(await job(session))
+                await session.commit()
+        except Exception:
+            log.debug("write batch of %d failed, replaying one by one", len(batch), exc_info=True)
+            return False
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
+        return True
+
+    @staticmethod
+    async def _run_one(job: WriteJob, fut: asyncio.Future) -> None:
+        try:
+            async with get_session() as session:
+                result = await job(session)
+                await session.commit()
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():
+                fut.set_result(result)
+
+
+async def _direct(job: WriteJob[T]) -> T:
+    async with get_session() as session:
+        result = await job(session)
+        await session.commit()
+    return result
+
+
+_queue = WriteQueue(settings.DB_WRITE_BATCH)
+
+
+def use_write_queue() -> bool:
+    mode = settings.DB_WRITE_QUEUE
+    if mode == "auto":
+        return engine.dialect.name == "sqlite"
+    return mode in {"1", "true", "yes", "on"}
+
+
+async def run_write(job: WriteJob[T]) -> T:
+    """Точка входа: через очередь (SQLite по умолчанию) или сразу в своей транзакции."""
+    if use_write_queue():
+        with span("db.write_queue"):
+            return await _queue.submit(job)
+    return await _direct(job)